@@ -77,7 +77,7 @@ function choose_datapoint(event) {
         nested_index.init()
         csv_idx = nested_index.ang2pix_nest(theta, phi) - 4*top_pixel
     }
-    csv_url = cat_url + '/Norder'+ order + '/Dir0/Npix' + top_pixel + '.tsv';
+    csv_url = cat_url + '/Norder'+ order + '/Dir' + Math.floor(top_pixel / 10000) * 10000 + '/Npix' + top_pixel + '.tsv';
     change_jasmine_view()
 }
 
@@ -86,11 +86,15 @@ function change_jasmine_view() {
     jasmine_div.style.backgroundImage = "";
     let cube_side = active_jasmine_radio.value;
     pc.clear_scene()
-    fetch(csv_url).then(response => response.text())
+    // sparse tilings have no catalog tile where there is no data
+    fetch(csv_url).then(response => response.ok ? response.text() : "")
         .then(
             data => {
                 let rows = data.split('\n')
-                let sh_id = rows[csv_idx+1].split('\t')[1]
+                let sh_id = rows.length > csv_idx+1 ? rows[csv_idx+1].split('\t')[1] : undefined
+                if(sh_id === "") {
+                    sh_id = undefined  // empty cells keep their row with empty columns
+                }
                 if(cube_side == "gascloud") {
                     display_gascloud(sh_id)
                 } else if(cube_side == "morphology") {
@@ -0,0 +1,301 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+
+import numpy as np
+import torch
+from PIL import Image
+
+from create_hips_sphere import Hipster, ImageStore, TileSink, peak_rss_mb
+
+
+def create_survey(folder, count, image_size, seed=0):
+    """Creates a synthetic survey: a catalog of random unit vectors and a PNG cutout per entry.
+
+    Args:
+        folder (Path): The folder to create the survey in.
+        count (int): The number of catalog entries and cutouts.
+        image_size (int): The edge length of the cutouts.
+        seed (int, optional): The seed of the random generator. Defaults to 0.
+
+    Returns:
+        tuple: The catalog file and the cutout folder.
+    """
+    rng = np.random.default_rng(seed)
+    cutouts = folder / "cutouts"
+    cutouts.mkdir(parents=True, exist_ok=True)
+    vectors = rng.normal(size=(count, 3))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = rng.choice(count * 10, count, replace=False)
+    catalog_file = folder / "catalog.csv"
+    with open(catalog_file, "w", encoding="utf-8") as output:
+        output.write("id,x,y,z\n")
+        for ident, (x, y, z) in zip(ids.tolist(), vectors.tolist()):
+            output.write(str(ident) + "," + repr(x) + "," + repr(y) + "," + repr(z) + "\n")
+    for ident in ids.tolist():
+        # smooth blobs compress like real cutouts, unlike white noise
+        coarse = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(coarse).resize((image_size, image_size), Image.BICUBIC)
+        image.save(cutouts / (str(ident) + ".png"))
+    return catalog_file, cutouts
+
+
+def folder_size(folder, pattern="*"):
+    """Returns the size of all files below a folder that match a pattern, in bytes."""
+    return sum(file.stat().st_size for file in Path(folder).rglob(pattern) if file.is_file())
+
+
+class Benchmark:
+    """Times the stages of a HiPS build and collects the results."""
+
+    def __init__(self, repeat=1, verbose=False):
+        """Initializes the benchmark
+
+        Args:
+            repeat (int, optional): How often every stage is run; the fastest run is reported.
+                Defaults to 1.
+            verbose (bool, optional): Whether to show the output of the pipeline.
+                Defaults to False.
+        """
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    def measure(self, stage, config, run, tiles=0, setup=None):
+        """Runs a stage and records its fastest run.
+
+        Args:
+            stage (String): The name of the stage.
+            config (dict): The settings the stage ran with.
+            run (function): Runs the stage and returns the number of bytes it processed.
+            tiles (int, optional): The number of tiles the stage produces. Defaults to 0.
+            setup (function, optional): Runs before every run of the stage, untimed.
+                Defaults to None.
+        """
+        seconds = []
+        processed = 0
+        for _ in range(self.repeat):
+            with self.quiet():
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                processed = run()
+                seconds.append(time.perf_counter() - start)
+        best = min(seconds)
+        result = dict(config)
+        result.update(
+            {
+                "stage": stage,
+                "seconds": best,
+                "tiles": tiles,
+                "tiles_per_second": tiles / best if tiles and best > 0 else None,
+                "megabytes": processed / 2**20,
+                "megabytes_per_second": processed / 2**20 / best if best > 0 else None,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+        self.results.append(result)
+        print(
+            "  "
+            + stage.ljust(24)
+            + format(best, ".3f").rjust(9)
+            + " s"
+            + (format(result["tiles_per_second"], ".1f").rjust(10) + " tiles/s" if tiles else "")
+        )
+        return result
+
+    def quiet(self):
+        """Returns a context hiding the progress output of the pipeline unless verbose."""
+        if self.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(io.StringIO())
+
+
+def benchmark_config(benchmark, folder, catalog_file, cutouts, max_order, hierarchy, workers):
+    """Benchmarks every stage of a build with the given tiling settings.
+
+    Args:
+        benchmark (Benchmark): The benchmark to record the results in.
+        folder (Path): The folder to build in.
+        catalog_file (Path): The catalog of the synthetic survey.
+        cutouts (Path): The cutouts of the synthetic survey.
+        max_order (int): The maximal HEALPix order of the tiling.
+        hierarchy (int): The hierarchy of the tiling.
+        workers (int): The number of processes of the full build.
+    """
+    config = {"max_order": max_order, "hierarchy": hierarchy, "workers": workers}
+    print("max_order " + str(max_order) + ", hierarchy " + str(hierarchy) + ":")
+
+    def hipster(distortion_correction=False):
+        return Hipster(
+            str(folder),
+            "benchmark",
+            max_order=max_order,
+            hierarchy=hierarchy,
+            distortion_correction=distortion_correction,
+            catalog_file=str(catalog_file),
+            interactive=False,
+        )
+
+    plain = hipster()
+    distorted = hipster(True)
+    levels = plain.hierarchy_levels()
+    tiles = 12 * 4**max_order
+
+    def open_catalog():
+        plain.open_catalog()
+        return os.path.getsize(catalog_file)
+
+    benchmark.measure(
+        "catalog_ingest",
+        config,
+        open_catalog,
+        setup=lambda: rmtree(plain.catalog_store_folder, ignore_errors=True),
+    )
+    benchmark.measure("catalog_open", config, open_catalog)
+    catalog = plain.open_catalog()
+
+    def healpix_cells():
+        plain.calculate_healpix_cells(
+            catalog,
+            range(len(catalog)),
+            max_order + levels,
+            range(12 * 4 ** (max_order + levels)),
+        )
+        return len(catalog) * 3 * 4  # the float32 positions
+
+    benchmark.measure("healpix_cells", config, healpix_cells)
+
+    def select_winners():
+        index = plain.index_catalog(catalog)
+        return np.concatenate(
+            [plain.select_winners(catalog, index, order) for order in range(index.order + 1)]
+        )
+
+    benchmark.measure("select_winners", config, lambda: select_winners().nbytes)
+    winners = select_winners()
+    benchmark.measure(
+        "pack_images",
+        config,
+        lambda: ImageStore.open_or_pack(plain.image_store_folder, cutouts).images.nbytes,
+        setup=lambda: rmtree(plain.image_store_folder, ignore_errors=True),
+    )
+    dataset = ImageStore.open_or_pack(plain.image_store_folder, cutouts)
+
+    sample = [dataset[int(ident)] for ident in dataset.ids[:64]]
+    for name, tiler in (("project_data", plain), ("project_data_distortion", distorted)):
+        benchmark.measure(
+            name,
+            config,
+            lambda tiler=tiler: sum(
+                tiler.project_data(image, max_order + levels, pixel % tiles).numel()
+                for pixel, image in enumerate(sample)
+            ),
+            tiles=len(sample),
+        )
+
+    rendered = {}
+    for name, tiler in (("render_tiles", plain), ("render_tiles_distortion", distorted)):
+
+        def render(tiler=tiler):
+            rendered["tiles"] = tiler.render_tiles(
+                dataset, catalog, max_order, list(range(tiles)), winners
+            )
+            return sum(data.nbytes for data in rendered["tiles"])
+
+        benchmark.measure(name, config, render, tiles=tiles)
+
+    def encode():
+        sink = TileSink(plain, "encode", str(folder / "encode.jsonl"))
+        for pixel, data in enumerate(rendered["tiles"]):
+            sink.write(max_order, pixel, data, "", [])
+        sink.flush()
+        return folder_size(plain.title_folder / "encode")
+
+    def reset_encode():
+        rmtree(plain.title_folder / "encode", ignore_errors=True)
+        plain.create_folders("encode")
+        Path(folder / "encode.jsonl").unlink(missing_ok=True)
+
+    benchmark.measure("encode_write", config, encode, tiles=tiles, setup=reset_encode)
+
+    def build():
+        plain.generate_dataset_projection(str(cutouts), workers=workers, allsky=False)
+        return folder_size(plain.title_folder / "projection", "Npix*")
+
+    def create_allsky():
+        plain.create_allsky()
+        return folder_size(plain.title_folder / "projection", "Allsky*")
+
+    total = sum(12 * 4**order for order in range(max_order + 1))
+    benchmark.measure("build", config, build, tiles=total)
+    benchmark.measure("create_allsky", config, create_allsky, tiles=total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the HiPS build pipeline.")
+    parser.add_argument("--images", type=int, default=2000, help="number of synthetic cutouts")
+    parser.add_argument("--image-size", type=int, default=128, help="edge length of cutouts")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--hierarchies", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--folder", default=None, help="work folder, temporary by default")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--verbose", action="store_true")
+    arguments = parser.parse_args()
+
+    if arguments.threads is not None:
+        torch.set_num_threads(arguments.threads)
+    with contextlib.ExitStack() as stack:
+        if arguments.folder is None:
+            folder = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        else:
+            folder = Path(arguments.folder)
+        print("Creating synthetic survey ...")
+        catalog_file, cutouts = create_survey(
+            folder / "survey", arguments.images, arguments.image_size
+        )
+        print("Creating synthetic survey ... done.")
+        benchmark = Benchmark(arguments.repeat, arguments.verbose)
+        for max_order in arguments.orders:
+            for hierarchy in arguments.hierarchies:
+                benchmark_config(
+                    benchmark,
+                    folder / ("build_" + str(max_order) + "_" + str(hierarchy)),
+                    catalog_file,
+                    cutouts,
+                    max_order,
+                    hierarchy,
+                    arguments.workers,
+                )
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+        },
+        "survey": {"images": arguments.images, "image_size": arguments.image_size},
+        "results": benchmark.results,
+    }
+    with open(arguments.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+    print("Results written to " + arguments.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,36 @@
+import contextlib
+import cProfile
+import errno
 import glob
+import hashlib
+import io
+import json
+import logging
 import math
 import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from astropy.io.votable import writeto
-from astropy.table import Table
 from pathlib import Path
-from shutil import rmtree
+from shutil import copyfile, rmtree
+from xml.sax.saxutils import escape
 
 import healpy
+from astropy.io import fits
 import numpy as np
 import torch
 from PIL import Image
-from matplotlib import pyplot as plt
 import pandas as pd
 import torchvision.transforms.functional as functional
-from skimage import io
-import torchvision.transforms.v2 as transforms
+
+try:
+    import resource  # Unix only, for the memory figures of the build metrics
+except ImportError:
+    resource = None
 
 
 class Hipster:
@@ -34,15 +49,40 @@ class Hipster:
         hierarchy: int = 1,
         crop_size: int = 64,
         distortion_correction: bool = False,
+        geometry_cache_folder: str = None,
+        geometry_cache_size: int = 64,
+        image_store_folder: str = None,
+        catalog_store_folder: str = None,
+        catalog_chunk_size: int = 2**20,
+        similarity_folder: str = None,
+        similarity_columns: list = (),
+        similarity_weights: list = None,
+        statistics_columns: list = (),
+        statistics_bins: int = 16,
+        allsky_edge_width: int = 64,
+        render_batch_size: int = 16,
+        render_threads: int = None,
+        model_batch_size: int = 256,
+        tile_format: str = "jpeg",
+        tile_quality: int = None,
+        encoder_threads: int = 4,
+        metrics_sinks: list = None,
+        profile_tiles: tuple = None,
+        profile_folder: str = None,
+        sparse: bool = False,
+        sparse_min_count: int = 2,
+        dedup: bool = False,
+        packed: bool = False,
         catalog_file: str = "catalog.csv",
         votable_file: str = "catalog.vot",
         hipster_url: str = "http://localhost:8000",
+        interactive: bool = True,
     ):
         """Initializes the Hipster
 
         Args:
             output_folder (String): The place where to export the HiPS to. In case it exists, there
-                is a user prompt before deleting the folder.
+                is a user prompt before deleting the folder, unless the build is incremental.
             title (String): The title string to be passed to the meta files.
             max_order (int, optional): The depth of the tiling. Should be smaller than 10.
                 Defaults to 3.
@@ -53,15 +93,73 @@ class Hipster:
             output_size (int, optional): Specifies the size the tilings should be scaled to. Must be
                 in the powers of 2. Defaults to 128.
             distortion_correction (bool, optional): Wether or not to apply a distortion correction
-            catalog_file (String, optional): The name of the catalog file to be generated.
-                Defaults to "catalog.csv".
+            geometry_cache_folder (String, optional): A folder to persist the distortion correction
+                sampling maps in, so that later builds can reuse them. Defaults to None, which
+                keeps them in memory only.
+            geometry_cache_size (int, optional): The number of sampling maps to keep in memory.
+                Defaults to 64.
+            image_store_folder (String, optional): The folder to pack the source images into.
+                Defaults to None, which uses the folder 'images' in the title folder.
+            catalog_store_folder (String, optional): The folder to ingest the catalog into.
+                Defaults to None, which uses the folder 'catalog' in the title folder.
+            catalog_chunk_size (int, optional): The number of catalog rows read at once while
+                ingesting. Defaults to 2**20.
+            similarity_folder (String, optional): The folder of the similarity index of the
+                catalog. Defaults to None, which uses the folder 'similarity' in the title folder.
+            similarity_columns (list, optional): The numeric catalog columns the similarity index
+                compares objects by besides their position. Defaults to ().
+            similarity_weights (list, optional): The weight of every similarity column, see
+                SimilarityIndex.features. Defaults to None.
+            statistics_columns (list, optional): The numeric catalog columns the statistics
+                tiles summarize besides the number of objects, see create_statistics_tiles.
+                Defaults to ().
+            statistics_bins (int, optional): The number of histogram bins of every statistics
+                column. Defaults to 16.
+            allsky_edge_width (int, optional): The edge length of a tile in the Allsky images.
+                Defaults to 64.
+            render_batch_size (int, optional): The number of images cropped and resized together.
+                Defaults to 16.
+            render_threads (int, optional): The number of torch threads for rendering. Defaults to
+                None, which keeps the torch default in the main process and uses one thread per
+                worker process.
+            model_batch_size (int, optional): The number of cell vectors a model reconstructs
+                at once, see generate_model_projection. Defaults to 256.
+            tile_format (String, optional): The image format of the tiles, one of "jpeg", "png"
+                and "webp". Defaults to "jpeg".
+            tile_quality (int, optional): The quality of lossy tile formats. Defaults to None,
+                which uses the encoder default.
+            encoder_threads (int, optional): The number of threads encoding and writing tiles
+                while the next tiles are rendered. Defaults to 4.
+            metrics_sinks (list, optional): The sinks the build metrics are reported to at the
+                end of a build, see BuildMetrics. Defaults to None.
+            profile_tiles (tuple, optional): The order and the first and last (exclusive) pixel
+                of the tiles whose rendering is profiled with cProfile. Defaults to None.
+            profile_folder (String, optional): The folder to write the profiles to. Defaults to
+                None, which uses the folder 'profiles' in the title folder.
+            sparse (bool, optional): Whether to only write the tiles that contain any image and a
+                MOC of them, so output size and build time scale with the data instead of the
+                sphere area. Sparse tilings may go deeper than order 9. Defaults to False.
+            sparse_min_count (int, optional): The number of objects a tile of a sparse tiling
+                beyond order 9 must hold to be subdivided further, so only densely populated
+                regions get deep tiles, see sparse_subdivided. Defaults to 2.
+            dedup (bool, optional): Whether tiles rendered from the same inputs share one encoded
+                file, see deduplicate_tiles. Defaults to False.
+            packed (bool, optional): Whether to pack the tiles of every order into one archive
+                instead of writing a file per tile, see TileArchive. Defaults to False.
+            catalog_file (String, optional): The name of the catalog file, a CSV, Parquet or
+                HDF5 file with at least the columns id, x, y and z. Defaults to "catalog.csv".
             votable_file (String, optional): The name of the votable file to be generated.
                 Defaults to "catalog.vot".
             hipster_url (String, optional): The url where the HiPSter will be hosted.
                 Defaults to "http://localhost:8082".
+            interactive (bool, optional): Whether to prompt before deleting existing output.
+                Defaults to True.
         """
 
-        assert max_order < 10
+        if sparse:
+            assert max_order + math.ceil(math.log2(max(hierarchy, 1))) <= 29
+        else:
+            assert max_order < 10
         self.output_folder = Path(output_folder)
         self.title = title
         self.title_folder = self.output_folder / Path(title)
@@ -70,55 +168,155 @@ class Hipster:
         self.crop_size = crop_size
         self.output_size = 512
         self.distortion_correction = distortion_correction
+        self.geometry_cache = TileGeometryCache(geometry_cache_folder, geometry_cache_size)
+        if image_store_folder is None:
+            self.image_store_folder = self.title_folder / Path("images")
+        else:
+            self.image_store_folder = Path(image_store_folder)
+        if catalog_store_folder is None:
+            self.catalog_store_folder = self.title_folder / Path("catalog")
+        else:
+            self.catalog_store_folder = Path(catalog_store_folder)
+        self.catalog_chunk_size = catalog_chunk_size
+        if similarity_folder is None:
+            self.similarity_folder = self.title_folder / Path("similarity")
+        else:
+            self.similarity_folder = Path(similarity_folder)
+        self.similarity_columns = list(similarity_columns)
+        self.similarity_weights = similarity_weights
+        self.statistics_columns = list(statistics_columns)
+        self.statistics_bins = statistics_bins
+        self.allsky_edge_width = allsky_edge_width
+        self.render_batch_size = render_batch_size
+        self.render_threads = render_threads
+        self.model_batch_size = model_batch_size
+        if tile_format not in TILE_FORMATS:
+            raise ValueError("Unsupported tile format " + str(tile_format))
+        self.tile_format = tile_format
+        self.tile_extension = TILE_FORMATS[tile_format][0]
+        self.tile_quality = tile_quality
+        self.encoder_threads = encoder_threads
+        self.metrics = BuildMetrics(metrics_sinks)
+        self.tile_buffers = TileBuffers()
+        self.profile_tiles = profile_tiles
+        if profile_folder is None:
+            self.profile_folder = self.title_folder / Path("profiles")
+        else:
+            self.profile_folder = Path(profile_folder)
         self.catalog_file = self.title_folder / Path(catalog_file)
         self.votable_file = self.title_folder / Path(votable_file)
         self.hipster_url = hipster_url
+        self.interactive = interactive
+        self.sparse = sparse
+        self.sparse_min_count = sparse_min_count
+        self.dedup = dedup
+        self.packed = packed
+        self.tile_archives = {}
 
         self.title_folder.mkdir(parents=True, exist_ok=True)
 
-    def check_folders(self, base_folder):
-        """Checks whether the base folder exists and deletes it after prompting for user input
+    def check_folders(self, base_folder, incremental=False):
+        """Checks whether the base folder exists and deletes it, after prompting for user input
+            in interactive mode. Incremental builds keep the folder.
 
         Args:
             base_folder (String): The base folder to check.
+            incremental (bool, optional): Whether the folder is kept to be updated.
+                Defaults to False.
         """
         path = os.path.join(self.output_folder, self.title, base_folder)
-        if os.path.exists(path):
+        if incremental or not os.path.exists(path):
+            return
+        if self.interactive:
             answer = input("path " + str(path) + ", delete? [y],n")
             if answer == "n":
                 exit(1)
-            else:
-                rmtree(os.path.join(self.output_folder, self.title, base_folder))
+        rmtree(path)
 
-    def create_folders(self, base_folder):
-        """Creates all folders and sub-folders to store the HiPS tiles.
+    def create_folders(self, base_folder, pixels=None, packed=False):
+        """Creates all folders and sub-folders to store the HiPS tiles. Existing folders are kept.
 
         Args:
             base_folder (String): The base folder to start the folder creation in.
+            pixels (dict, optional): The pixels of the tiles to store by order, only the folders
+                holding any of them are created. Defaults to None, which creates the folders of
+                every tile.
+            packed (bool, optional): Whether the tiles are packed into archives, which only
+                need the order folders. Defaults to False.
         """
         print("creating folders:")
-        if not os.path.exists(self.output_folder):
-            os.mkdir(self.output_folder)
-        if not os.path.exists(os.path.join(self.output_folder, self.title)):
-            os.mkdir(os.path.join(self.output_folder, self.title))
-        os.mkdir(os.path.join(self.output_folder, self.title, base_folder))
         for i in range(self.max_order + 1):
-            os.mkdir(
-                os.path.join(
-                    self.output_folder, self.title, base_folder, "Norder" + str(i)
-                )
+            os.makedirs(
+                os.path.join(self.output_folder, self.title, base_folder, "Norder" + str(i)),
+                exist_ok=True,
             )
-            for j in range(int(math.floor(12 * 4**i / 10000)) + 1):
-                os.mkdir(
+            if packed:
+                folders = []
+            elif pixels is None:
+                folders = range(12 * 4**i // 10000 + 1)
+            else:
+                folders = np.unique(np.asarray(pixels.get(i, []), dtype=np.int64) // 10000)
+            for j in folders:
+                os.makedirs(
                     os.path.join(
                         self.output_folder,
                         self.title,
                         base_folder,
                         "Norder" + str(i),
-                        "Dir" + str(j * 10000),
-                    )
+                        "Dir" + str(int(j) * 10000),
+                    ),
+                    exist_ok=True,
                 )
 
+    def tile_file(self, base_folder, order, pixel, extension=None):
+        """Returns the path of a HiPS tile.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            extension (String, optional): The file extension of the tile. Defaults to None, which
+                uses the extension of the tile format.
+        """
+        if extension is None:
+            extension = self.tile_extension
+        return os.path.join(
+            self.output_folder,
+            self.title,
+            base_folder,
+            "Norder" + str(order),
+            "Dir" + str(int(pixel) // 10000 * 10000),
+            "Npix" + str(pixel) + "." + extension,
+        )
+
+    def tile_archive(self, base_folder):
+        """Returns the archive the tiles of a packed tiling are stored in.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+        """
+        if base_folder not in self.tile_archives:
+            self.tile_archives[base_folder] = TileArchive(self.title_folder / Path(base_folder))
+        return self.tile_archives[base_folder]
+
+    def read_tile(self, base_folder, order, pixel, extension=None):
+        """Returns the encoded bytes of a tile, None if the tiling does not have it.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            extension (String, optional): The file extension of the tile. Defaults to None,
+                which uses the extension of the tile format.
+        """
+        if self.packed:
+            return self.tile_archive(base_folder).read(order, pixel)
+        file = self.tile_file(base_folder, order, pixel, extension)
+        if not os.path.exists(file):
+            return None
+        with open(file, "rb") as encoded:
+            return encoded.read()
+
     def create_hips_properties(self, base_folder):
         """Generates the properties file that contains the meta-information of the HiPS tiling.
 
@@ -142,7 +340,7 @@ class Hipster:
             output.write("hips_creation_date   = " + datetime.now().isoformat() + "\n")
             output.write("hips_release_date    = " + datetime.now().isoformat() + "\n")
             output.write("hips_status          = public master clonable\n")
-            output.write("hips_tile_format     = jpeg\n")
+            output.write("hips_tile_format     = " + self.tile_format + "\n")
             output.write("hips_order           = " + str(self.max_order) + "\n")
             output.write(
                 "hips_tile_width      = "
@@ -210,7 +408,9 @@ class Hipster:
                 + "',"
                 + "'equatorial', "
                 + str(self.max_order)
-                + ", {imgFormat: 'jpg'})); \n"
+                + ", {imgFormat: '"
+                + self.tile_extension
+                + "'})); \n"
             )
             output.write("            aladin.setFoV(180.0); \n")
             output.write("        });\n")
@@ -220,22 +420,7 @@ class Hipster:
             output.flush()
 
     def calculate_pixels(self, matrix, pixel):
-        size = matrix.shape[0]
-        if size > 1:
-            matrix[: size // 2, : size // 2] = self.calculate_pixels(
-                matrix[: size // 2, : size // 2], pixel * 4
-            )
-            matrix[size // 2 :, : size // 2] = self.calculate_pixels(
-                matrix[size // 2 :, : size // 2], pixel * 4 + 1
-            )
-            matrix[: size // 2, size // 2 :] = self.calculate_pixels(
-                matrix[: size // 2, size // 2 :], pixel * 4 + 2
-            )
-            matrix[size // 2 :, size // 2 :] = self.calculate_pixels(
-                matrix[size // 2 :, size // 2 :], pixel * 4 + 3
-            )
-        else:
-            matrix = pixel
+        matrix[:] = torch.from_numpy(nested_subpixels(pixel, matrix.shape[0]))
         return matrix
 
     def project_data(self, data, order, pixel):
@@ -249,69 +434,140 @@ class Hipster:
         result = torch.zeros(
             (self.output_size, self.output_size, 3)
         )  # * torch.tensor((77.0/255.0, 0.0/255.0, 153.0/255.0)).reshape(3,1).T[:,None]
-        healpix_pixel = torch.zeros(
-            (self.output_size, self.output_size), dtype=torch.int64
+        sampling = torch.from_numpy(
+            self.geometry_cache.get(order, pixel, self.output_size, data.shape[0])
         )
-        healpix_pixel = self.calculate_pixels(healpix_pixel, pixel)
-        center_theta, center_phi = healpy.pix2ang(
-            2**order, pixel, nest=True
-        )  # theta 0...180 phi 0...360
-        size = data.shape[0]
-        max_theta = max_phi = 2 * math.pi / (4 * 2**order) / 2
-        for x in range(self.output_size):
-            for y in range(self.output_size):
-                target_theta, target_phi = healpy.pix2ang(
-                    2**order * self.output_size, healpix_pixel[x, y], nest=True
-                )
-                delta_theta = target_theta - center_theta
-                if center_phi == 0 and target_phi > math.pi:
-                    delta_phi = (target_phi - center_phi - 2 * math.pi) * math.sin(
-                        target_theta
-                    )
-                else:
-                    delta_phi = (target_phi - center_phi) * math.sin(target_theta)
-                target_x = int(size // 2 + delta_phi / max_phi * (size // 2 - 1))
-                target_y = int(size // 2 + delta_theta / max_theta * (size // 2 - 1))
-                if (
-                    target_x >= 0
-                    and target_y >= 0
-                    and target_x < size
-                    and target_y < size
-                ):
-                    result[x, y] = data[target_x, target_y]
-                # else:
-                #     result[x,y] = 0
+        valid = sampling >= 0
+        result[valid] = data.reshape(-1, data.shape[2])[sampling[valid]].to(result.dtype)
         return result
 
-    def generate_tile(self, data, order, pixel, hierarchy, index):
-        if hierarchy <= 1:
-            vector = healpy.pix2vec(2**order, pixel, nest=True)
-            vector = torch.tensor(vector).reshape(1, 3).type(dtype=torch.float32)
-            with torch.no_grad():
-                reconstruction = data[index]  # model.reconstruct(vector)[0]
-            return self.project_data(reconstruction, order, pixel)
-        q1 = self.generate_tile(data, order + 1, pixel * 4, hierarchy / 2, index * 4)
-        q2 = self.generate_tile(
-            data, order + 1, pixel * 4 + 1, hierarchy / 2, index * 4 + 1
-        )
-        q3 = self.generate_tile(
-            data, order + 1, pixel * 4 + 2, hierarchy / 2, index * 4 + 2
-        )
-        q4 = self.generate_tile(
-            data, order + 1, pixel * 4 + 3, hierarchy / 2, index * 4 + 3
+    def generate_tile(self, model, order, pixel, hierarchy=None):
+        """Generates a tile from the reconstructions of a model at the centers of its leaves.
+
+        Args:
+            model (torch.nn.Module): Maps unit vectors to images, see reconstruct.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            hierarchy (int, optional): The number of leaves per tile edge. Defaults to None,
+                which uses the hierarchy of the hipster.
+
+        Returns:
+            torch.Tensor: The (height, width, 3) uint8 tile.
+        """
+        return torch.from_numpy(self.generate_tiles(model, order, [pixel], hierarchy)[0])
+
+    def generate_tiles(self, model, order, pixels, hierarchy=None, recycle=False):
+        """Generates tiles from the reconstructions of a model. The center vectors of all their
+            leaves are computed with one pix2vec call and reconstructed in batches.
+
+        Args:
+            model (torch.nn.Module): Maps unit vectors to images, see reconstruct.
+            order (int): The HEALPix order of the tiles.
+            pixels (list): The nested HEALPix pixels of the tiles.
+            hierarchy (int, optional): The number of leaves per tile edge. Defaults to None,
+                which uses the hierarchy of the hipster.
+            recycle (bool, optional): Whether to render into buffers of tile_buffers, see
+                render_tiles. Defaults to False.
+
+        Returns:
+            list: The (height, width, 3) uint8 tiles.
+        """
+        hierarchy = self.hierarchy if hierarchy is None else hierarchy
+        levels = math.ceil(math.log2(hierarchy)) if hierarchy > 1 else 0
+        side = 2**levels
+        layout = nested_subpixels(0, side)
+        size = self.output_size
+        leaves = (
+            np.asarray(pixels, dtype=np.int64)[:, None] * side**2
+            + np.arange(side**2, dtype=np.int64)
+        ).ravel()
+        vectors = np.stack(healpy.pix2vec(2 ** (order + levels), leaves, nest=True), axis=1)
+        with self.metrics.stage("inference", order):
+            images = self.reconstruct(model, vectors)
+        with self.metrics.stage("project", order):
+            data = self.project_leaves(images, order + levels, leaves).numpy()
+        tiles = []
+        for i in range(len(pixels)):
+            shape = (side * size, side * size, 3)
+            tile = self.tile_buffers.acquire(shape) if recycle else np.empty(shape, np.uint8)
+            for row in range(side):
+                for column in range(side):
+                    tile[
+                        row * size : (row + 1) * size, column * size : (column + 1) * size
+                    ] = data[i * side**2 + int(layout[row, column])]
+            tiles.append(tile)
+        return tiles
+
+    def reconstruct(self, model, vectors):
+        """Reconstructs images from unit vectors in batches of model_batch_size, without
+            tracking gradients.
+
+        Args:
+            model (torch.nn.Module): Maps a (batch, 3) float32 tensor of unit vectors to a
+                (batch, channels, height, width) tensor of RGB images, uint8 or float in [0, 1].
+                Models with a reconstruct method, like the Spherinator models, are called through
+                it.
+            vectors (numpy.ndarray): The (N, 3) unit vectors.
+
+        Returns:
+            torch.Tensor: The (N, 3, height, width) uint8 images.
+        """
+        if self.render_threads is not None:
+            torch.set_num_threads(self.render_threads)
+        reconstruct = getattr(model, "reconstruct", model)
+        parameter = next(iter(model.parameters()), None) if hasattr(model, "parameters") else None
+        device = parameter.device if parameter is not None else torch.device("cpu")
+        vectors = torch.from_numpy(np.asarray(vectors, dtype=np.float32))
+        images = []
+        with torch.inference_mode():
+            for start in range(0, len(vectors), self.model_batch_size):
+                batch = reconstruct(vectors[start : start + self.model_batch_size].to(device))
+                batch = batch[:, :3].cpu()
+                if batch.is_floating_point():
+                    batch = (batch.clamp(0, 1) * 255).round().to(torch.uint8)
+                images.append(batch)
+        return torch.cat(images)
+
+    def model_digest(self, model):
+        """Returns a digest of the weights of a model, so incremental builds render the tiles of
+            a changed model again.
+
+        Args:
+            model (torch.nn.Module): The model.
+        """
+        digest = hashlib.blake2b(type(model).__name__.encode(), digest_size=16)
+        if hasattr(model, "state_dict"):
+            for name, value in model.state_dict().items():
+                digest.update(name.encode())
+                digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def open_catalog(self):
+        """Opens the ingested catalog, ingesting the catalog file first if it changed."""
+        return CatalogStore.open_or_ingest(
+            self.catalog_store_folder, self.catalog_file, self.catalog_chunk_size
         )
-        result = torch.ones((q1.shape[0] * 2, q1.shape[1] * 2, 3))
-        result[: q1.shape[0], : q1.shape[1]] = q1
-        result[q1.shape[0] :, : q1.shape[1]] = q2
-        result[: q1.shape[0], q1.shape[1] :] = q3
-        result[q1.shape[0] :, q1.shape[1] :] = q4
-        return result
+
+    def similarity_index(self, catalog=None):
+        """Opens the similarity index of the catalog, building it first if the catalog or the
+            similarity columns changed, see SimilarityIndex.
+
+        Args:
+            catalog (CatalogStore, optional): The catalog. Defaults to None, which opens it.
+        """
+        catalog = self.open_catalog() if catalog is None else catalog
+        with self.metrics.stage("similarity"):
+            return SimilarityIndex.open_or_build(
+                self.similarity_folder,
+                catalog,
+                self.similarity_columns,
+                self.similarity_weights,
+            )
 
     def transform_csv_to_votable(self):
         print("Transforming catalog.csv to votable ...")
 
-        table = Table.read(self.catalog_file, format="ascii.csv")
-        writeto(table, str(self.votable_file))
+        self.open_catalog().write_votable(str(self.votable_file))
 
         print("Transforming catalog.csv to votable ... done.")
 
@@ -319,224 +575,3581 @@ class Hipster:
         healpix_cells = {}  # create an extra map to quickly find images in a cell
         for pixel in pixels:
             healpix_cells[pixel] = []  # create empty lists for each cell
-        for number in numbers:
-            pixel = healpy.vec2pix(
-                2**order,
-                catalog[number][1],
-                catalog[number][2],
-                catalog[number][3],
-                nest=True,
-            )
+        numbers = np.asarray(numbers, dtype=np.int64)
+        vectors = catalog.positions(numbers)
+        cells = healpy.vec2pix(
+            2**order, vectors[:, 0], vectors[:, 1], vectors[:, 2], nest=True
+        )
+        for number, pixel in zip(numbers.tolist(), cells.tolist()):
             if pixel in healpix_cells:
-                healpix_cells[pixel].append(int(number))
+                healpix_cells[pixel].append(number)
         return healpix_cells
 
-    def embed_tile(self, dataset, catalog, order, pixel, hierarchy, idx):
-        if hierarchy <= 1:
-            if len(idx) == 0:
-                data = torch.ones((3, self.output_size, self.output_size))
-                data[0] = data[0] * 77.0 / 255.0  # deep purple
-                data[1] = data[1] * 0.0 / 255.0
-                data[2] = data[2] * 153.0 / 255.0
-                data = torch.swapaxes(data, 0, 2)
-            else:
-                vector = healpy.pix2vec(2**order, pixel, nest=True)
-                distances = np.sum(
-                    np.square(catalog[np.array(idx)][:, 3:6] - vector), axis=1
-                )
-                best = idx[np.argmin(distances)]
-                data = dataset[int(catalog[best][0])]
-                data = functional.center_crop(
-                    data, [self.crop_size, self.crop_size]
-                )  # crop
-                data = self.project_data(data, order, pixel)
-            return data
-        healpix_cells = self.calculate_healpix_cells(
-            catalog, idx, order + 1, range(pixel * 4, pixel * 4 + 4)
+    def hierarchy_levels(self):
+        """Returns the number of orders below its own order that a tile combines."""
+        return math.ceil(math.log2(self.hierarchy)) if self.hierarchy > 1 else 0
+
+    def tile_digest(self, mode, ids=(), hashes=(), children=()):
+        """Hashes everything a tile is rendered from: the tiling parameters, the ids of the
+            selected catalog rows and the hashes of their images, or the digests of the child
+            tiles it is composed of.
+
+        Args:
+            mode (String): The kind of tiling, including its own parameters.
+            ids (numpy.ndarray, optional): The ids of the source images, -1 for empty cells.
+            hashes (numpy.ndarray, optional): The hashes of the source images.
+            children (list, optional): The digests of the child tiles.
+        """
+        parameters = [
+            mode,
+            self.tile_format,
+            self.tile_quality,
+            self.output_size,
+            self.crop_size,
+            self.hierarchy,
+            self.distortion_correction,
+        ]
+        digest = hashlib.blake2b(repr(parameters).encode(), digest_size=16)
+        digest.update(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(hashes, dtype=np.uint64).tobytes())
+        digest.update("".join(children).encode())
+        return digest.hexdigest()
+
+    def tile_is_current(self, manifest, base_folder, order, pixel, digest):
+        """Checks whether a tile was completed from the inputs with the given digest.
+
+        Args:
+            manifest (TileManifest): The manifest of the tiles written so far.
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            digest (String): The digest of the current inputs of the tile.
+        """
+        if not manifest.is_current(order, pixel, digest):
+            return False
+        if self.packed:
+            return self.tile_archive(base_folder).find(order, pixel) is not None
+        return os.path.exists(self.tile_file(base_folder, order, pixel))
+
+    def plan_tiles(
+        self, manifest, base_folder, order, mode, ids, hashes, incremental, pixels=None
+    ):
+        """Determines which tiles of an order have to be (re-)rendered.
+
+        Args:
+            manifest (TileManifest): The manifest of the tiles written so far.
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tiles.
+            mode (String): The kind of tiling, see tile_digest.
+            ids (numpy.ndarray): The source image ids of every tile, one row per pixel.
+            hashes (numpy.ndarray): The matching source image hashes.
+            incremental (bool): Whether tiles with unchanged inputs are kept.
+            pixels (numpy.ndarray, optional): The pixel of every row of ids and hashes.
+                Defaults to None, which means row i is pixel i.
+
+        Returns:
+            list: The (pixel, digest, ids) of every tile to render.
+        """
+        tiles = []
+        for i in range(len(ids)):
+            pixel = i if pixels is None else int(pixels[i])
+            digest = self.tile_digest(mode, ids[i], hashes[i])
+            if incremental and self.tile_is_current(manifest, base_folder, order, pixel, digest):
+                continue
+            tiles.append((pixel, digest, ids[i].tolist()))
+        return tiles
+
+    def index_catalog(self, catalog):
+        """Builds the spatial index of a catalog down to the deepest order any tile needs.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+        """
+        return CatalogIndex.build(
+            catalog.positions(),
+            self.max_order + self.hierarchy_levels(),
+        )
+
+    def select_winners(self, catalog, index, order):
+        """Finds the catalog row closest to the cell center for every cell of an order at once.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            index (CatalogIndex): The spatial index of the catalog.
+            order (int): The HEALPix order of the cells, at most the index order.
+
+        Returns:
+            numpy.ndarray: The winning catalog row of every cell, -1 for empty cells.
+        """
+        cells, rows = self.select_occupied_winners(catalog, index, order)
+        winners = np.full(12 * 4**order, -1, dtype=np.int64)
+        winners[cells] = rows
+        return winners
+
+    def select_occupied_winners(self, catalog, index, order):
+        """Finds the catalog row closest to the cell center for every occupied cell of an order.
+
+        The centers of the occupied cells come from a single pix2vec call, and a segmented argmin
+        over the pixel-sorted catalog rows picks the closest row per cell.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            index (CatalogIndex): The spatial index of the catalog.
+            order (int): The HEALPix order of the cells, at most the index order.
+
+        Returns:
+            tuple: The sorted occupied cells and their winning catalog rows.
+        """
+        pixels = np.asarray(index.pixels) >> (2 * (index.order - order))
+        rows = np.asarray(index.rows)
+        if len(pixels) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        starts = np.flatnonzero(np.concatenate([[True], pixels[1:] != pixels[:-1]]))
+        cells = pixels[starts]
+        segments = np.repeat(np.arange(len(cells)), np.diff(np.append(starts, len(pixels))))
+        centers = np.stack(healpy.pix2vec(2**order, cells, nest=True), axis=1)
+        distances = np.sum(
+            np.square(catalog.positions(rows) - centers[segments]),
+            axis=1,
         )
-        q1 = self.embed_tile(
-            dataset,
-            catalog,
-            order + 1,
-            pixel * 4,
-            hierarchy / 2,
-            healpix_cells[pixel * 4],
+        ranking = np.lexsort((distances, segments))  # stable, so ties keep the first row
+        return cells, rows[ranking[starts]]
+
+    def select_all_winners(self, catalog, index):
+        """Selects the winners of every order down to the index order.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            index (CatalogIndex): The spatial index of the catalog.
+
+        Returns:
+            numpy.ndarray or SparseWinners: The pyramid of selected catalog rows, only of the
+                occupied cells for sparse tilings.
+        """
+        if self.sparse:
+            levels = self.hierarchy_levels()
+            cells, rows = map(
+                list,
+                zip(
+                    *[
+                        self.select_occupied_winners(catalog, index, order)
+                        for order in range(index.order + 1)
+                    ]
+                ),
+            )
+            for order in range(levels, index.order + 1):
+                keep = self.sparse_subdivided(index, order - levels, cells[order] >> (2 * levels))
+                cells[order], rows[order] = cells[order][keep], rows[order][keep]
+            return SparseWinners(cells, rows)
+        return np.concatenate(
+            [self.select_winners(catalog, index, order) for order in range(index.order + 1)]
         )
-        q2 = self.embed_tile(
-            dataset,
-            catalog,
-            order + 1,
-            pixel * 4 + 1,
-            hierarchy / 2,
-            healpix_cells[pixel * 4 + 1],
+
+    def sparse_subdivided(self, index, order, pixels):
+        """Returns which tiles of an order a sparse tiling renders. Every occupied tile up to
+            order 9 is rendered, deeper tiles only if their parent holds at least
+            sparse_min_count objects, so sparse regions stop at the order that resolves them.
+
+        Args:
+            index (CatalogIndex): The spatial index of the catalog.
+            order (int): The HEALPix order of the tiles.
+            pixels (numpy.ndarray): The nested HEALPix pixels of the tiles.
+
+        Returns:
+            numpy.ndarray: Whether each tile is rendered.
+        """
+        pixels = np.asarray(pixels, dtype=np.int64)
+        if order <= MAX_DENSE_ORDER:
+            return np.ones(pixels.shape, dtype=bool)
+        parents = np.asarray(index.pixels) >> (2 * (index.order - order + 1))
+        counts = np.searchsorted(parents, pixels >> 2, side="right") - np.searchsorted(
+            parents, pixels >> 2
         )
-        q3 = self.embed_tile(
-            dataset,
-            catalog,
-            order + 1,
-            pixel * 4 + 2,
-            hierarchy / 2,
-            healpix_cells[pixel * 4 + 2],
+        return counts >= self.sparse_min_count
+
+    def tile_pixels(self, winners, order):
+        """Returns the pixels of the tiles of an order to render, only the occupied ones for
+            sparse tilings.
+
+        Args:
+            winners (numpy.ndarray or SparseWinners): The pyramid of selected catalog rows.
+            order (int): The HEALPix order of the tiles.
+        """
+        if isinstance(winners, SparseWinners):
+            return winners.tiles(order, self.hierarchy_levels())
+        return np.arange(12 * 4**order, dtype=np.int64)
+
+    def leaf_winners(self, winners, order, pixels, levels=None):
+        """Returns the selected catalog rows of the leaves of tiles, in nested order.
+
+        Args:
+            winners (numpy.ndarray or SparseWinners): The pyramid of selected catalog rows.
+            order (int): The HEALPix order of the tiles.
+            pixels (numpy.ndarray): The nested HEALPix pixels of the tiles.
+            levels (int, optional): The number of orders below the tiles their leaves are at.
+                Defaults to None, which uses the hierarchy of the hipster.
+
+        Returns:
+            numpy.ndarray: One row of 4**levels catalog rows per tile, -1 for empty leaves.
+        """
+        levels = self.hierarchy_levels() if levels is None else levels
+        leaves = (
+            np.asarray(pixels, dtype=np.int64)[:, None] * 4**levels
+            + np.arange(4**levels, dtype=np.int64)
+        ).ravel()
+        if isinstance(winners, SparseWinners):
+            rows = winners.lookup(order + levels, leaves)
+        else:
+            rows = winners[pyramid_offset(order + levels) + leaves]
+        return rows.reshape(-1, 4**levels)
+
+    def embed_tile(self, dataset, catalog, order, pixel, hierarchy, winners):
+        return torch.from_numpy(
+            np.array(self.render_tiles(dataset, catalog, order, [pixel], winners, hierarchy)[0])
         )
-        q4 = self.embed_tile(
-            dataset,
-            catalog,
-            order + 1,
-            pixel * 4 + 3,
-            hierarchy / 2,
-            healpix_cells[pixel * 4 + 3],
+
+    def render_leaves(self, images, order, pixels):
+        """Crops and projects a batch of images into leaf tiles.
+
+        Args:
+            images (list): The (channel, width, height) uint8 source images.
+            order (int): The HEALPix order of the leaves.
+            pixels (list): The nested HEALPix pixel of each leaf.
+
+        Returns:
+            torch.Tensor: The (batch, output_size, output_size, 3) uint8 leaves.
+        """
+        batch = functional.center_crop(torch.stack(images), [self.crop_size, self.crop_size])
+        return self.project_leaves(batch, order, pixels)
+
+    def project_leaves(self, batch, order, pixels):
+        """Projects a batch of images into leaf tiles.
+
+        Args:
+            batch (torch.Tensor): The (batch, channel, width, height) uint8 images.
+            order (int): The HEALPix order of the leaves.
+            pixels (list): The nested HEALPix pixel of each leaf.
+
+        Returns:
+            torch.Tensor: The (batch, output_size, output_size, 3) uint8 leaves.
+        """
+        if not self.distortion_correction:
+            batch = functional.resize(
+                batch, [self.output_size, self.output_size], antialias=True
+            )  # scale
+            return torch.swapaxes(batch, 1, 3)
+        batch = torch.swapaxes(batch, 1, 3)
+        flat = batch.reshape(batch.shape[0], -1, batch.shape[3])
+        result = torch.zeros(
+            (batch.shape[0], self.output_size, self.output_size, 3), dtype=torch.uint8
         )
-        result = torch.ones((q1.shape[0] * 2, q1.shape[1] * 2, 3))
-        result[: q1.shape[0], : q1.shape[1]] = q1
-        result[q1.shape[0] :, : q1.shape[1]] = q2
-        result[: q1.shape[0], q1.shape[1] :] = q3
-        result[q1.shape[0] :, q1.shape[1] :] = q4
+        hits, misses = self.geometry_cache.hits, self.geometry_cache.misses
+        for i, pixel in enumerate(pixels):
+            sampling = torch.from_numpy(
+                self.geometry_cache.get(order, pixel, self.output_size, batch.shape[1])
+            )
+            valid = sampling >= 0
+            result[i][valid] = flat[i][sampling[valid]]
+        self.metrics.count("geometry_cache_hits", self.geometry_cache.hits - hits, order)
+        self.metrics.count("geometry_cache_misses", self.geometry_cache.misses - misses, order)
         return result
 
-    def generate_dataset_projection(self, data_path):
+    def render_tiles(
+        self, dataset, catalog, order, pixels, winners, hierarchy=None, recycle=False
+    ):
+        """Renders dataset projection tiles, cropping and projecting their leaf images in batches.
+
+        The leaves of a tile are placed with the quadrant layout of the nested scheme straight
+        into the views of a single uint8 buffer, empty leaves are filled with deep purple. Tiles
+        without any image are the shared read-only empty tile of tile_buffers.
+
+        Args:
+            dataset (ImageStore): The source images.
+            catalog (CatalogStore): The catalog.
+            order (int): The HEALPix order of the tiles.
+            pixels (list): The nested HEALPix pixels of the tiles.
+            winners (numpy.ndarray or SparseWinners): The pyramid of selected catalog rows.
+            hierarchy (int, optional): The number of leaves per tile edge. Defaults to None,
+                which uses the hierarchy of the hipster.
+            recycle (bool, optional): Whether to render into buffers of tile_buffers, which the
+                tile sink returns to the pool once the tiles are encoded. Defaults to False.
+
+        Returns:
+            list: The (height, width, 3) uint8 tiles.
+        """
+        if self.render_threads is not None:
+            torch.set_num_threads(self.render_threads)
+        hierarchy = self.hierarchy if hierarchy is None else hierarchy
+        levels = math.ceil(math.log2(hierarchy)) if hierarchy > 1 else 0
+        side = 2**levels
+        layout = nested_subpixels(0, side)
+        leaf_order = order + levels
+        size = self.output_size
+        shape = (side * size, side * size, 3)
+        cells = self.leaf_winners(winners, order, pixels, levels)
+        tiles = []
+        leaves = []
+        for i, pixel in enumerate(pixels):
+            if np.all(cells[i] < 0):
+                tiles.append(self.tile_buffers.constant(shape, EMPTY_COLOR))
+                continue
+            if recycle:
+                tile = self.tile_buffers.acquire(shape)
+            else:
+                tile = np.empty(shape, dtype=np.uint8)
+            for row in range(side):
+                for column in range(side):
+                    leaf = pixel * side**2 + int(layout[row, column])
+                    view = tile[row * size : (row + 1) * size, column * size : (column + 1) * size]
+                    best = cells[i, int(layout[row, column])]
+                    if best < 0:
+                        view[:] = EMPTY_COLOR
+                    else:
+                        leaves.append((view, leaf, int(catalog.ids[best])))
+            tiles.append(tile)
+        self.metrics.count("leaves", len(leaves), order)
+        self.metrics.count("empty_leaves", len(pixels) * side**2 - len(leaves), order)
+        for start in range(0, len(leaves), self.render_batch_size):
+            batch = leaves[start : start + self.render_batch_size]
+            with self.metrics.stage("read", order):
+                images = [dataset[ident] for _, _, ident in batch]
+            with self.metrics.stage("project", order):
+                data = self.render_leaves(images, leaf_order, [leaf for _, leaf, _ in batch])
+                for (view, _, _), leaf in zip(batch, data.numpy()):
+                    view[:] = leaf
+        return tiles
+
+    def save_image(self, image, file):
+        """Encodes an image in the tile format.
+
+        Args:
+            image (PIL.Image.Image): The image to save.
+            file (String): The file to save the image to.
+        """
+        options = {}
+        if self.tile_quality is not None:
+            options["quality"] = self.tile_quality
+        image.save(file, TILE_FORMATS[self.tile_format][1], **options)
+
+    def save_tile(self, base_folder, order, pixel, data, key=None):
+        """Saves a rendered tile.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            data (numpy.ndarray): The (height, width, 3) uint8 tile.
+            key (String, optional): The content key of the tile. Keyed tiles are encoded once
+                into their blob, which the tile is linked to, unless the tiling is packed.
+                Defaults to None.
+        """
+        file = self.tile_file(base_folder, order, pixel)
+        with self.metrics.stage("encode", order):
+            if self.packed:
+                encoded = io.BytesIO()
+                self.save_image(Image.fromarray(data), encoded)
+                self.tile_archive(base_folder).append(order, pixel, encoded.getvalue())
+                return
+            if key is None:
+                if os.path.isfile(file) and os.stat(file).st_nlink > 1:
+                    os.unlink(file)  # never write through a link shared with other tiles
+                self.save_image(Image.fromarray(data), file)
+                return
+            blob = self.blob_file(base_folder, key)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                part = blob + "." + str(os.getpid())
+                self.save_image(Image.fromarray(data), part)
+                os.replace(part, blob)  # a blob is complete once it exists
+            self.link_tile(base_folder, order, pixel, blob)
+
+    def blob_file(self, base_folder, key):
+        """Returns the path of the encoded tile all tiles with the given content key share.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            key (String): The content key of the tiles.
+        """
+        return os.path.join(
+            self.title_folder,
+            "tile_blobs",
+            base_folder,
+            key[:2],
+            key + "." + self.tile_extension,
+        )
+
+    def link_tile(self, base_folder, order, pixel, blob):
+        """Replaces a tile by a hard link to a blob, or by a copy where hard links are not
+            supported.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            blob (String): The blob file.
+        """
+        file = self.tile_file(base_folder, order, pixel)
+        part = file + ".link"
+        try:
+            os.link(blob, part)
+        except OSError as error:
+            if error.errno != errno.EMLINK:
+                copyfile(blob, part)
+            else:  # the blob has as many links as the file system allows, start a new inode
+                renewed = blob + "." + str(os.getpid())
+                copyfile(blob, renewed)
+                os.replace(renewed, blob)
+                os.link(blob, part)
+        os.replace(part, file)
+
+    def prune_blobs(self, base_folder):
+        """Deletes the blobs of a tiling that no tile links to any more, e.g. after an
+            incremental build replaced their tiles. Packed tilings and file systems without hard
+            links hold copies of the blobs, so all their blobs are deleted.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+        """
+        folder = os.path.join(self.title_folder, "tile_blobs", base_folder)
+        if not os.path.isdir(folder):
+            return
+        pruned = 0
+        with os.scandir(folder) as prefixes:
+            for prefix in prefixes:
+                with os.scandir(prefix.path) as blobs:
+                    for blob in blobs:
+                        if blob.stat().st_nlink == 1:
+                            os.unlink(blob.path)
+                            pruned += 1
+                with contextlib.suppress(OSError):
+                    os.rmdir(prefix.path)  # only if it is empty
+        self.metrics.count("pruned_blobs", pruned)
+
+    def deduplicate_tiles(self, sink, order, tiles):
+        """Splits the planned tiles of an order into the tiles to render and the duplicates of
+            tiles with the same content key, which are only linked to their shared blob.
+
+        The content key of a tile is its digest, so a tile is only rendered once per build for
+        every combination of source images, and not at all if an earlier order or build already
+        encoded it. Packed tilings keep no blobs, so they only reuse tiles of the same build.
+
+        Args:
+            sink (TileSink): The sink the tiles are written to, which remembers the rendered
+                tile of every key.
+            order (int): The HEALPix order of the tiles.
+            tiles (list): The (pixel, digest, ids) of the tiles to render.
+
+        Returns:
+            tuple: The tiles to render, and the duplicates with the (order, pixel) of the
+                rendered tile they copy, None if their blob is from an earlier build.
+        """
+        render = []
+        duplicates = []
+        for tile in tiles:
+            key = sink.content_key(tile[1], tile[2])
+            if key is None:
+                render.append(tile)
+            elif key in sink.sources:
+                duplicates.append((tile, sink.sources[key]))
+            elif not self.packed and os.path.exists(self.blob_file(sink.base_folder, key)):
+                duplicates.append((tile, None))
+            else:
+                sink.sources[key] = (order, tile[0])
+                render.append(tile)
+        self.metrics.count("deduplicated", len(duplicates), order)
+        return render, duplicates
+
+    def link_duplicates(self, sink, order, duplicates):
+        """Writes the duplicate tiles of an order once their blobs are encoded. Duplicates in
+            packed tilings share the archived bytes of the tile they copy instead.
+
+        Args:
+            sink (TileSink): The sink the tiles are written to.
+            order (int): The HEALPix order of the tiles.
+            duplicates (list): The duplicates, see deduplicate_tiles.
+        """
+        if self.packed:
+            self.tile_archive(sink.base_folder).share(
+                order, [(pixel, source) for (pixel, _, _), source in duplicates]
+            )
+        for (pixel, digest, ids), source in duplicates:
+            sink.link(order, pixel, digest, ids, source)
+        sink.flush()
+
+    def reduce_tile(self, data):
+        """Downsamples a tile by 2 with a 2x2 box filter, to the quadrant it fills in its parent.
+
+        Args:
+            data (numpy.ndarray): The (height, width, 3) uint8 tile.
+        """
+        total = data[0::2, 0::2].astype(np.uint16)
+        total += data[1::2, 0::2]
+        total += data[0::2, 1::2]
+        total += data[1::2, 1::2]
+        total += 2
+        total //= 4
+        return total.astype(np.uint8)
+
+    def reduced_folder(self, base_folder):
+        """Returns the folder of the reduced tiles of a bottom-up tiling, outside of the tiling.
+
+        Composed tiles are built from the reduced copies of their children instead of decoding
+        the lossy tile files, so incremental builds compose exactly the tiles a fresh build does.
+        Every tile above order 0 keeps its copy as a PNG, lossless and compressed.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+        """
+        return self.title_folder / Path("bottom_up_cache") / Path(base_folder)
+
+    def reduced_file(self, base_folder, order, pixel):
+        """Returns the file of the reduced copy of a tile, see reduced_folder.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+        """
+        return os.path.join(
+            self.reduced_folder(base_folder),
+            "Norder" + str(order),
+            "Dir" + str(int(pixel) // 10000 * 10000),
+            "Npix" + str(pixel) + ".png",
+        )
+
+    def keep_reduced(self, base_folder, order, pixel, data):
+        """Stores the reduced copy of a tile its parent is composed from.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile, at least 1.
+            pixel (int): The nested HEALPix pixel of the tile.
+            data (numpy.ndarray): The (height, width, 3) uint8 tile.
+        """
+        with self.metrics.stage("reduce", order):
+            file = self.reduced_file(base_folder, order, pixel)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            part = file + "." + str(os.getpid())
+            Image.fromarray(self.reduce_tile(data)).save(part, "PNG", compress_level=1)
+            os.replace(part, file)  # a copy is complete once it exists
+
+    def compose_tile(self, base_folder, order, pixel):
+        """Builds a tile from its four child tiles: they are combined with the quadrant layout of
+            embed_tile and the result is downsampled by 2 with a 2x2 box filter. The children are
+            read from their reduced copies, see reduced_folder.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+        """
+        with self.metrics.stage("read", order + 1):
+            children = np.stack(
+                [
+                    np.array(Image.open(self.reduced_file(base_folder, order + 1, child)))
+                    for child in range(pixel * 4, pixel * 4 + 4)
+                ]
+            )
+        with self.metrics.stage("compose", order):
+            half_height, half_width = children.shape[1:3]
+            shape = (2 * half_height, 2 * half_width, 3)
+            if np.all(children == EMPTY_COLOR):
+                return self.tile_buffers.constant(shape, EMPTY_COLOR)
+            result = np.empty(shape, dtype=np.uint8)
+            corners = [(0, 0), (half_height, 0), (0, half_width), (half_height, half_width)]
+            for child, (top, left) in zip(children, corners):
+                result[top : top + half_height, left : left + half_width] = child
+            return result
+
+    @contextlib.contextmanager
+    def profile(self, order, pixels):
+        """Profiles the rendering of tiles with cProfile if any of them is in profile_tiles.
+
+        The profile is written to profile_folder as Norder{order}_Npix{first pixel}.prof, to be
+        read with pstats or snakeviz. Sampling profilers such as py-spy need no hook, they attach
+        to the build and its workers from outside (py-spy record --subprocesses --pid ...).
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+            pixels (list): The nested HEALPix pixels of the tiles.
+        """
+        if self.profile_tiles is None:
+            yield
+            return
+        profile_order, first, last = self.profile_tiles
+        if order != profile_order or not any(first <= pixel < last for pixel in pixels):
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profile_folder.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(
+                self.profile_folder
+                / ("Norder" + str(order) + "_Npix" + str(pixels[0]) + ".prof")
+            )
+
+    def generate_dataset_projection(
+        self,
+        data_path,
+        workers=1,
+        incremental=False,
+        bottom_up=False,
+        allsky=True,
+        catalog_tiles=True,
+        binary_catalog=False,
+        similarity=False,
+        statistics=False,
+    ):
         """Generates a HiPS tiling by using the coordinates of every image to map the original
             images form the data set based on their distance to the closest heal pixel cell
             center.
 
         Args:
-            datamodule (SpherinatorDataModule): The datamodule to access the original images
+            data_path (String): The folder containing the original images.
+            workers (int, optional): The number of processes to render the tiles with.
+                Defaults to 1.
+            incremental (bool, optional): Whether to keep the existing tiling and only render
+                tiles whose inputs changed or that were not completed yet. Defaults to False.
+            bottom_up (bool, optional): Whether to render only the tiles of max_order from the
+                images and to compose every lower order from its child tiles, like common HiPS
+                generators do. Defaults to False.
+            allsky (bool, optional): Whether to collect the Allsky images while the tiles are
+                rendered. Defaults to True.
+            catalog_tiles (bool, optional): Whether to write the catalog tiles of the selected
+                images, see create_catalog_tiles. Defaults to True.
+            binary_catalog (bool, optional): Whether to write the binary variant of the catalog
+                tiles as well. Defaults to False.
+            similarity (bool, optional): Whether to build the similarity index of the catalog,
+                see similarity_index. Defaults to False.
+            statistics (bool, optional): Whether to write the statistics tiles of the catalog,
+                see create_statistics_tiles. Defaults to False.
         """
+        if bottom_up and self.sparse:
+            raise ValueError("Bottom-up builds compose every tile and cannot be sparse.")
         print("Generating dataset projection ...")
+        start = time.perf_counter()
+
+        self.check_folders("projection", incremental)
 
-        self.check_folders("projection")
-        self.create_folders("projection")
+        with self.metrics.stage("catalog"):
+            catalog = self.open_catalog()
+        self.metrics.count("catalog", len(catalog))
+
+        with self.metrics.stage("images"):
+            dataset = ImageStore.open_or_pack(self.image_store_folder, data_path, catalog.ids)
+        self.metrics.count("images", len(dataset))
+        with self.metrics.stage("winners"):
+            index = self.index_catalog(catalog)
+            winners = self.select_all_winners(catalog, index)
+            pixels = {
+                order: self.tile_pixels(winners, order) for order in range(self.max_order + 1)
+            }
+        self.create_folders("projection", pixels if self.sparse else None, self.packed)
         self.create_hips_properties("projection")
         self.create_index_file("projection")
+        manifest = TileManifest(self.title_folder / Path("projection") / Path("manifest.jsonl"))
+        if self.sparse:
+            self.create_moc("projection", pixels)
+        if similarity:
+            self.similarity_index(catalog)
+        if statistics:
+            with self.metrics.stage("statistics"):
+                self.create_statistics_tiles(catalog, index, incremental=incremental)
+        if catalog_tiles:
+            with self.metrics.stage("catalog_tiles"):
+                self.create_catalog_tiles(
+                    catalog, winners, binary=binary_catalog, incremental=incremental
+                )
+        sink, refill = self.create_tile_sink(
+            "projection",
+            manifest,
+            allsky,
+            incremental,
+            dedup=self.dedup and not bottom_up,
+            positional=self.distortion_correction,
+        )
+
+        if bottom_up:
+            ids = np.where(winners >= 0, catalog.ids[winners], -1)
+            hashes = np.where(winners >= 0, dataset.hashes[dataset.rows(ids)], 0)
+            self.project_bottom_up(
+                workers, manifest, sink, catalog, dataset, winners, ids, hashes, incremental
+            )
+            self.finish_tiling(sink, manifest, refill)
+            self.metrics.add("build", None, seconds=time.perf_counter() - start, calls=1)
+            self.metrics.report(self.title)
+            print("Generating dataset projection ... done.")
+            return
+        # top-down builds do not keep the reduced tiles of later bottom-up builds up to date
+        rmtree(self.reduced_folder("projection"), ignore_errors=True)
+
+        with TilePool(
+            self,
+            workers,
+            catalog=catalog,
+            dataset=dataset,
+            winners=winners,
+            sink=sink,
+        ) as pool:
+            for i in range(self.max_order + 1):
+                rows = self.leaf_winners(winners, i, pixels[i])
+                ids = np.where(rows >= 0, catalog.ids[rows], -1)
+                tiles = self.plan_tiles(
+                    manifest,
+                    "projection",
+                    i,
+                    "embed",
+                    ids,
+                    np.where(rows >= 0, dataset.hashes[dataset.rows(ids)], 0),
+                    incremental,
+                    pixels[i],
+                )
+                print(
+                    "\n  order "
+                    + str(i)
+                    + " ["
+                    + str(len(tiles)).rjust(
+                        int(math.log10(12 * 4**self.max_order)) + 1, " "
+                    )
+                    + " tiles]:",
+                    end="",
+                )
+                self.metrics.count("tiles", len(tiles), i)
+                with self.metrics.stage("order", i):
+                    tiles, duplicates = self.deduplicate_tiles(sink, i, tiles)
+                    pool.run(embed_tiles, [(i, chunk) for chunk in pool.chunks(tiles)])
+                    self.link_duplicates(sink, i, duplicates)
+        self.finish_tiling(sink, manifest, refill)
+        self.metrics.add("build", None, seconds=time.perf_counter() - start, calls=1)
+        self.metrics.report(self.title)
 
-        catalog = pd.read_csv(
-            self.catalog_file,
-            usecols=["id", "x", "y", "z"],
-        ).to_numpy()
+        print("Generating dataset projection ... done.")
 
-        dataset = get_data_dict(data_path, catalog)
+    def project_bottom_up(
+        self, workers, manifest, sink, catalog, dataset, winners, ids, hashes, incremental
+    ):
+        """Renders the dataset projection bottom-up: only max_order is projected from the images,
+            each parent tile is composed from its four children.
 
-        for i in range(self.max_order + 1):
-            healpix_cells = self.calculate_healpix_cells(
-                catalog, range(catalog.shape[0]), i, range(12 * 4**i)
-            )
-            print(
-                "\n  order "
-                + str(i)
-                + " ["
-                + str(12 * 4**i).rjust(
-                    int(math.log10(12 * 4**self.max_order)) + 1, " "
+        The subtrees below a split order are rendered depth-first by the tile pool, then the
+        orders above the split are composed. Every tile is composed from the reduced copies of its
+        children, see reduced_folder, so each process only holds one tile per order in memory.
+        A tile digest covers the digests of its children, so ancestors of changed tiles are
+        rendered again in incremental builds, from the same reduced copies a fresh build uses.
+
+        Args:
+            workers (int): The number of processes to render the tiles with.
+            manifest (TileManifest): The manifest of the tiles written so far.
+            sink (TileSink): The sink to write the tiles to.
+            catalog (CatalogStore): The catalog.
+            dataset (ImageStore): The source images.
+            winners (numpy.ndarray): The pyramid of selected catalog rows.
+            ids (numpy.ndarray): The pyramid of selected image ids.
+            hashes (numpy.ndarray): The pyramid of selected image hashes.
+            incremental (bool): Whether tiles with unchanged inputs are kept.
+        """
+        leaf_order = self.max_order + self.hierarchy_levels()
+        leaves = slice(pyramid_offset(leaf_order), pyramid_offset(leaf_order + 1))
+        n_pix = 12 * 4**self.max_order
+        leaf_ids = ids[leaves].reshape(n_pix, -1)
+        leaf_hashes = hashes[leaves].reshape(n_pix, -1)
+        digests = [[] for _ in range(self.max_order + 1)]
+        digests[self.max_order] = [
+            self.tile_digest("embed", leaf_ids[pixel], leaf_hashes[pixel])
+            for pixel in range(n_pix)
+        ]
+        for order in reversed(range(self.max_order)):
+            digests[order] = [
+                self.tile_digest(
+                    "bottom-up", children=digests[order + 1][pixel * 4 : pixel * 4 + 4]
                 )
-                + " tiles]:",
-                end="",
+                for pixel in range(12 * 4**order)
+            ]
+        if not incremental:
+            rmtree(self.reduced_folder("projection"), ignore_errors=True)
+        current = [
+            np.array(
+                [
+                    incremental
+                    and self.tile_is_current(manifest, "projection", order, pixel, digest)
+                    and (
+                        order == 0
+                        or os.path.exists(self.reduced_file("projection", order, pixel))
+                    )
+                    for pixel, digest in enumerate(digests[order])
+                ],
+                dtype=bool,
             )
+            for order in range(self.max_order + 1)
+        ]
+        for order in reversed(range(self.max_order)):
+            # tiles are only skipped with their subtree, which has to be complete
+            current[order] &= current[order + 1].reshape(-1, 4).all(axis=1)
+        current = np.concatenate(current)
 
+        split_order = 0
+        while split_order < self.max_order and 12 * 4**split_order < workers:
+            split_order += 1
+        with TilePool(
+            self,
+            workers,
+            catalog=catalog,
+            dataset=dataset,
+            winners=winners,
+            digests=np.array(sum(digests, [])),
+            current=current,
+            sink=sink,
+        ) as pool:
+            print("\n  orders " + str(split_order) + "-" + str(self.max_order) + ":", end="")
+            pool.run(
+                bottom_up_tiles,
+                [(split_order, chunk) for chunk in pool.chunks(range(12 * 4**split_order))],
+            )
+        for order in reversed(range(split_order)):
+            print("\n  order " + str(order) + ":", end="")
+            for pixel in range(12 * 4**order):
+                if current[pyramid_offset(order) + pixel]:
+                    continue
+                data = self.compose_tile("projection", order, pixel)
+                if order > 0:
+                    self.keep_reduced("projection", order, pixel, data)
+                sink.write(order, pixel, data, digests[order][pixel], [])
 
-            for j in range(12*4**i):
-                data = self.embed_tile(dataset, catalog, i, j, self.hierarchy, healpix_cells[j])
-                image = Image.fromarray((data.detach().numpy().astype(np.uint8)))
-                image.save(os.path.join(self.output_folder, self.title, "projection", "Norder"+str(i),
-                                        "Dir"+str(int(math.floor(j/10000))*10000), "Npix"+str(j)+".jpg"))
+    def generate_model_projection(
+        self, model, base_folder="model", incremental=False, allsky=True
+    ):
+        """Generates a HiPS tiling from a model that maps the center vector of every cell to an
+            image, e.g. the decoder of a Spherinator model.
 
-            print("Generating dataset projection ... done.")
+        The model runs in the calling process in batches of model_batch_size, with render_threads
+        torch threads; the encoder threads of the tile sink encode and write the previous tiles
+        meanwhile.
 
-    def create_allsky(self, dir_id=0, edge_width=64, extension="jpg"):
-        print("Create allsky images ...")
-        data_directory = os.path.join(self.title_folder, 'projection')
-        for order in range(self.max_order + 1):
-            width = math.floor(math.sqrt(12 * 4 ** order))
-            height = math.ceil(12 * 4 ** order / width)
-            result = torch.zeros((edge_width * height, edge_width * width, 3))
+        Args:
+            model (torch.nn.Module): Maps unit vectors to images, see reconstruct.
+            base_folder (String, optional): The base folder of the tiling. Defaults to "model".
+            incremental (bool, optional): Whether to keep the tiles already rendered from the
+                same model. Defaults to False.
+            allsky (bool, optional): Whether to collect the Allsky images while the tiles are
+                rendered. Defaults to True.
+        """
+        if self.sparse:
+            raise ValueError("Model projections fill every tile and cannot be sparse.")
+        print("Generating model projection ...")
+        start = time.perf_counter()
 
-            for i in range(12 * 4 ** order):
-                file = (
-                            data_directory
-                            / Path("Norder" + str(order))
-                            / Path("Dir" + str(dir_id))
-                            / Path("Npix" + str(i) + "." + extension)
+        self.check_folders(base_folder, incremental)
+        self.create_folders(base_folder, packed=self.packed)
+        self.create_hips_properties(base_folder)
+        self.create_index_file(base_folder)
+        manifest = TileManifest(self.title_folder / Path(base_folder) / Path("manifest.jsonl"))
+        sink, refill = self.create_tile_sink(base_folder, manifest, allsky, incremental)
+        mode = "model " + self.model_digest(model)
+        group = max(1, self.model_batch_size // 4 ** self.hierarchy_levels())
 
-                        )
-                if not file.exists():
-                    raise RuntimeError("File not found: " + str(file))
-
-                image = torch.swapaxes(torch.Tensor(io.imread(file)), 0, 2) / 255.0
-                image = transforms.functional.resize(image, [64, 64], antialias=True)
-                image = torch.swapaxes(image, 0, 2)
-
-                x = i % width
-                y = math.floor(i / width)
-                result[
-                    y * edge_width: (y + 1) * edge_width,
-                    x * edge_width: (x + 1) * edge_width,
-                ] = image
-            image = Image.fromarray(
-                (np.clip(result.numpy(), 0, 1) * 255).astype(np.uint8), mode="RGB"
-            )
-            image.save(data_directory / Path("Norder" + str(order)) / Path("Allsky.jpg"))
-        print("Create allsky images ... done.")
+        if hasattr(model, "eval"):
+            model.eval()
+        for order in range(self.max_order + 1):
+            n_pix = 12 * 4**order
+            tiles = self.plan_tiles(
+                manifest,
+                base_folder,
+                order,
+                mode,
+                np.empty((n_pix, 0), dtype=np.int64),
+                np.empty((n_pix, 0), dtype=np.uint64),
+                incremental,
+            )
+            print("\n  order " + str(order) + " [" + str(len(tiles)) + " tiles]:", end="")
+            self.metrics.count("tiles", len(tiles), order)
+            with self.metrics.stage("order", order):
+                for first in range(0, len(tiles), group):
+                    batch = tiles[first : first + group]
+                    pixels = [pixel for pixel, _, _ in batch]
+                    with self.profile(order, pixels):
+                        data = self.generate_tiles(model, order, pixels, recycle=True)
+                    for (pixel, digest, ids), tile in zip(batch, data):
+                        sink.write(order, pixel, tile, digest, ids)
+                sink.flush()
+        self.finish_tiling(sink, manifest, refill)
+        self.metrics.add("build", None, seconds=time.perf_counter() - start, calls=1)
+        self.metrics.report(self.title)
 
-    def make_hips_hierarchy(self, data_path, circle=True):
-        self.check_folders("projection")
-        self.create_folders("projection")
-        self.create_hips_properties("projection")
-        self.create_index_file("projection")
+        print("\nGenerating model projection ... done.")
 
-        dataset = get_data_np(data_path)
-        ds_idx = 0
-        dataset_length = dataset.shape[0]
+    def create_catalog_tiles(
+        self, catalog, winners, base_folder="interaction_catalog", binary=False, incremental=False
+    ):
+        """Writes the catalog HiPS the viewer inspects clicked cells with. Every tile gets a small
+            TSV file with one row per cell of the tile, in nested order, holding the catalog entry
+            shown in that cell. Empty cells keep their row, with empty columns.
 
-        print("Creating Healpix tiles...")
-        for order in range(self.max_order+1):
-            n_side = 2**(order)
-            n_pix = 12 * n_side**2
-
-            for pix in range(n_pix):
-                if circle or ds_idx < dataset_length:
-                    data = dataset[ds_idx % dataset_length]
-                    ds_idx += 1
-                else:
-                    data = np.ones((3, self.output_size, self.output_size))
-                    data[0] = data[0] * 77.0  # deep purple
-                    data[1] = data[1] * 0.0
-                    data[2] = data[2] * 153.0
-                    data = np.swapaxes(data, 0, 2)
-
-                image = Image.fromarray((data.astype(np.uint8)))
-                image = crop_center(image, self.crop_size, self.crop_size)
-                image = image.resize((512, 512))
-                image.save(os.path.join(self.output_folder, self.title, "projection", "Norder" + str(order),
-                                        "Dir" + str(int(math.floor(pix / 10000)) * 10000), "Npix" + str(pix) + ".jpg"))
-        print("...done.")
+        The binary variant stores every order in a single columnar file, Norder{order}/Catalog.bin:
+        first the pixel (uint64) and the number of filled cells of every tile (uint32), then the
+        id (int64, -1 for empty cells), ra and dec (float32) of every cell. Tiles have a fixed
+        number of cells, so a tile is a plain byte range of each column; catalog_index.json lists
+        the columns, their byte offsets and the cells per tile.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            winners (numpy.ndarray or SparseWinners): The pyramid of selected catalog rows, sparse
+                tilings only get the catalog tiles of their occupied tiles.
+            base_folder (String, optional): The base folder of the catalog tiles.
+                Defaults to "interaction_catalog".
+            binary (bool, optional): Whether to write the binary variant as well.
+                Defaults to False.
+            incremental (bool, optional): Whether to keep the existing catalog tiles and only
+                write the files whose content changed. Defaults to False.
+        """
+        print("Creating catalog tiles ...")
 
+        self.check_folders(base_folder, incremental)
+        pixels = {order: self.tile_pixels(winners, order) for order in range(self.max_order + 1)}
+        self.create_folders(base_folder, pixels if self.sparse else None)
+        leaves = 4 ** self.hierarchy_levels()
+        ra, dec = healpy.vec2ang(catalog.positions(), lonlat=True)
+        columns = [
+            ("pixel", "<u8"),
+            ("count", "<u4"),
+            ("id", "<i8"),
+            ("ra", "<f4"),
+            ("dec", "<f4"),
+        ]
+        index = {"cells_per_tile": leaves, "columns": columns, "orders": []}
+        for order in range(self.max_order + 1):
+            tiles = len(pixels[order])
+            rows = self.leaf_winners(winners, order, pixels[order])
+            filled = rows >= 0
+            ids = np.where(filled, catalog.ids[rows], -1)
+            for i, pixel in enumerate(pixels[order].tolist()):
+                lines = ["cell\tid\tra\tdec"]
+                for cell in range(leaves):
+                    if filled[i, cell]:
+                        row = rows[i, cell]
+                        lines.append(
+                            str(cell)
+                            + "\t"
+                            + str(ids[i, cell])
+                            + "\t"
+                            + format(ra[row], ".6f")
+                            + "\t"
+                            + format(dec[row], ".6f")
+                        )
+                    else:
+                        lines.append(str(cell) + "\t\t\t")
+                write_changed(
+                    self.tile_file(base_folder, order, pixel, "tsv"),
+                    ("\n".join(lines) + "\n").encode("utf-8"),
+                )
+            if binary:
+                data = [
+                    pixels[order].astype("<u8"),
+                    filled.sum(axis=1).astype("<u4"),
+                    ids.astype("<i8"),
+                    np.where(filled, ra[rows], np.nan).astype("<f4"),
+                    np.where(filled, dec[rows], np.nan).astype("<f4"),
+                ]
+                offsets = np.cumsum([0] + [column.nbytes for column in data[:-1]])
+                file = "Norder" + str(order) + "/Catalog.bin"
+                write_changed(
+                    os.path.join(self.title_folder, base_folder, file),
+                    b"".join(column.tobytes() for column in data),
+                )
+                index["orders"].append(
+                    {"order": order, "file": file, "tiles": tiles, "offsets": offsets.tolist()}
+                )
+            print(".", end="", flush=True)
 
-def get_data_dict(path, catalog, test_plot=False):
-    data = {}
-    for ident in catalog[:,0]:
-        ident = int(ident)
-        img = torch.tensor(np.array( Image.open(os.path.join(path, '{0}.png'.format(ident)))))
-        data[ident] = torch.swapaxes(img[:,:,:3], 0, 2)
-    # img_array = np.stack(img_array, axis=0)
-    if test_plot:
-        plt.imshow(data.values()[0])
-        plt.show()
-    return data
+        with open(
+            os.path.join(self.title_folder, base_folder, "properties"), "w", encoding="utf-8"
+        ) as output:
+            output.write("creator_did          = ivo://HITS/hipster\n")
+            output.write("obs_title            = " + self.title + " catalog\n")
+            output.write("dataproduct_type     = catalog\n")
+            output.write("hips_version         = 1.4\n")
+            output.write("hips_creation_date   = " + datetime.now().isoformat() + "\n")
+            output.write("hips_status          = public master clonable\n")
+            output.write("hips_tile_format     = tsv\n")
+            output.write("hips_order           = " + str(self.max_order) + "\n")
+            output.write("hips_cat_nrows       = " + str(len(catalog)) + "\n")
+            output.write("hips_frame           = equatorial\n")
+        if binary:
+            with open(
+                os.path.join(self.title_folder, base_folder, "catalog_index.json"),
+                "w",
+                encoding="utf-8",
+            ) as output:
+                json.dump(index, output, indent=2)
 
+        print("\nCreating catalog tiles ... done.")
 
-def get_data_np(path):
-    file_names = sorted(glob.glob("{0}/*.png".format(path)))
-    # img_array = np.array([np.array(fits.getdata(fname)) for fname in file_names])
-    img_array = np.array([np.array(Image.open(fname))[:,:,:3] for fname in file_names])
-    return img_array
+    def create_moc(self, base_folder, pixels):
+        """Writes the MOC (multi-order coverage map) of a sparse tiling, Moc.fits, so the viewer
+            knows which tiles exist, and adds its sky fraction to the properties.
 
+        The MOC holds the deepest tile of every region, i.e. the tiles without rendered
+        children, as sparse regions stop before max_order, see sparse_subdivided. Cells are
+        merged into their parents wherever all four siblings exist and stored as NUNIQ numbers,
+        4 * 4**order + pixel, as the MOC standard requires.
 
-def crop_center(img, cropx, cropy):
-    width, height = img.size
-    left = (width - cropx) / 2
-    top = (height - cropy) / 2
-    right = (width + cropx) / 2
-    bottom = (height + cropy) / 2
+        Args:
+            base_folder (String): The base folder of the tiling.
+            pixels (dict): The nested HEALPix pixels of the tiles of every order.
+        """
+        cells = np.empty(0, dtype=np.int64)
+        uniq = []
+        fraction = 0.0
+        for order in range(self.max_order, -1, -1):
+            tiles = np.asarray(pixels[order], dtype=np.int64)
+            if order < self.max_order:
+                tiles = tiles[~np.isin(tiles, np.asarray(pixels[order + 1], dtype=np.int64) >> 2)]
+            cells = np.union1d(cells, tiles)
+            if order == 0:
+                complete = np.empty(0, dtype=np.int64)
+            else:
+                parents, counts = np.unique(cells >> 2, return_counts=True)
+                complete = parents[counts == 4]
+            leaves = cells[~np.isin(cells >> 2, complete)]
+            uniq.append(4 * 4**order + leaves)
+            fraction += len(leaves) / (12 * 4**order)
+            cells = complete
+        table = fits.BinTableHDU.from_columns(
+            [fits.Column(name="UNIQ", format="K", array=np.sort(np.concatenate(uniq)))]
+        )
+        table.header["PIXTYPE"] = "HEALPIX"
+        table.header["ORDERING"] = "NUNIQ"
+        table.header["COORDSYS"] = "C"
+        table.header["MOCORDER"] = self.max_order
+        table.header["MOCTOOL"] = "hipster"
+        folder = os.path.join(self.title_folder, base_folder)
+        table.writeto(os.path.join(folder, "Moc.fits"), overwrite=True)
+        with open(os.path.join(folder, "properties"), "a", encoding="utf-8") as output:
+            output.write(
+                "moc_sky_fraction     = "
+                + format(fraction, ".8f")
+                + "\n"
+            )
+
+    def create_statistics_tiles(
+        self, catalog, index, base_folder="statistics", incremental=False
+    ):
+        """Writes the statistics pyramid of the catalog as tiles the viewer can fetch like image
+            tiles, so colouring by an attribute or summarizing a region costs a request per
+            visible tile instead of reading objects.
+
+        Every occupied tile gets a binary file, Norder{order}/Dir{dir}/Npix{pixel}.stats, with
+        the statistics of its cells in the layout described by StatisticsPyramid.tiles, and
+        statistics.json lists the columns, their histogram bin edges and the cells per tile.
+        Tiles without objects have no file, and neither have the tiles a sparse tiling does
+        not render, see sparse_subdivided.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            index (CatalogIndex): The spatial index of the catalog, see index_catalog.
+            base_folder (String, optional): The base folder of the statistics tiles.
+                Defaults to "statistics".
+            incremental (bool, optional): Whether to keep the existing statistics tiles and only
+                write the files whose content changed. Defaults to False.
+
+        Returns:
+            StatisticsPyramid: The statistics, e.g. to summarize regions.
+        """
+        print("Creating statistics tiles ...")
+
+        self.check_folders(base_folder, incremental)
+        levels = self.hierarchy_levels()
+        pyramid = StatisticsPyramid.build(
+            catalog, index, self.statistics_columns, self.statistics_bins
+        )
+        pixels = {}
+        for order in range(self.max_order + 1):
+            pixels[order] = np.unique(pyramid.level(order + levels)["cells"] >> (2 * levels))
+            if self.sparse:
+                pixels[order] = pixels[order][self.sparse_subdivided(index, order, pixels[order])]
+        self.create_folders(base_folder, pixels)
+        for order in range(self.max_order + 1):
+            kept = set(pixels[order].tolist())
+            for pixel, data in zip(*pyramid.tiles(order, levels)):
+                if int(pixel) not in kept:
+                    continue
+                write_changed(self.tile_file(base_folder, order, pixel, "stats"), data)
+            print(".", end="", flush=True)
+        with open(
+            os.path.join(self.title_folder, base_folder, "statistics.json"), "w", encoding="utf-8"
+        ) as output:
+            json.dump(
+                {
+                    "cells_per_tile": 4**levels,
+                    "bins": self.statistics_bins,
+                    "columns": [
+                        {"name": name, "edges": edges.tolist()}
+                        for name, edges in zip(pyramid.columns, pyramid.edges)
+                    ],
+                    "blocks": ["count <u4"]
+                    + ["valid <u4", "min <f4", "max <f4", "mean <f4", "histogram <u4"]
+                    * len(pyramid.columns),
+                    "orders": self.max_order + 1,
+                },
+                output,
+                indent=2,
+            )
+
+        print("\nCreating statistics tiles ... done.")
+        return pyramid
+
+    def allsky_mosaic(self, base_folder, order, edge_width=None):
+        """Returns the Allsky mosaic of an order of a tiling.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            order (int): The HEALPix order.
+            edge_width (int, optional): The edge length of a tile in the mosaic.
+                Defaults to None, which uses allsky_edge_width.
+        """
+        return AllskyMosaic(
+            self.title_folder
+            / Path("allsky_cache")
+            / Path(base_folder + "_Norder" + str(order) + ".npy"),
+            order,
+            edge_width if edge_width is not None else self.allsky_edge_width,
+        )
+
+    def allsky_orders(self):
+        """Returns the orders that get an Allsky image. Sparse tilings only get them for the
+            orders up to 3 that the viewer shows them at, deeper mosaics would be huge and empty.
+        """
+        if self.sparse:
+            return range(min(self.max_order, 3) + 1)
+        return range(self.max_order + 1)
+
+    def allsky_color(self):
+        """Returns the color of the tiles missing from the Allsky images, None for black."""
+        return EMPTY_COLOR if self.sparse else None
+
+    def create_tile_sink(
+        self, base_folder, manifest, allsky, incremental, dedup=False, positional=False
+    ):
+        """Creates the sink the tiles of a build are written to.
+
+        Args:
+            base_folder (String): The base folder of the tiling.
+            manifest (TileManifest): The manifest of the tiles written so far.
+            allsky (bool): Whether to stream the tiles into the Allsky mosaics.
+            incremental (bool): Whether the build keeps the existing tiling.
+            dedup (bool, optional): Whether tiles with the same digest share one blob.
+                Defaults to False.
+            positional (bool, optional): Whether the content of tiles with images depends on
+                their position and not only on their digest. Defaults to False.
+
+        Returns:
+            tuple: The sink and the orders whose Allsky mosaic could not be kept and has to be
+                refilled from the tiling after an incremental build.
+        """
+        mosaics = {}
+        refill = []
+        if allsky:
+            for order in self.allsky_orders():
+                mosaics[order] = self.allsky_mosaic(base_folder, order)
+                if not mosaics[order].prepare(incremental, self.allsky_color()) and incremental:
+                    refill.append(order)
+        return (
+            TileSink(
+                self,
+                base_folder,
+                str(manifest.file),
+                mosaics,
+                dedup=dedup,
+                positional=positional,
+            ),
+            refill,
+        )
+
+    def finish_tiling(self, sink, manifest, refill):
+        """Flushes the sink, compacts the manifest, compacts and indexes the tile archives of
+            packed tilings, prunes the blobs of deduplicated tilings and saves the Allsky images
+            of a build.
+
+        Args:
+            sink (TileSink): The sink the tiles were written to.
+            manifest (TileManifest): The manifest of the build.
+            refill (list): The orders whose Allsky mosaic has to be refilled from the tiling.
+        """
+        sink.flush()
+        manifest.compact()
+        if self.packed:
+            for order in range(self.max_order + 1):
+                self.tile_archive(sink.base_folder).compact(order, 0.5)
+                self.tile_archive(sink.base_folder).index(order)
+        if sink.dedup:
+            self.prune_blobs(sink.base_folder)
+        for order, mosaic in sink.mosaics.items():
+            with self.metrics.stage("allsky", order):
+                if order in refill:
+                    self.fill_allsky(mosaic, sink.base_folder)
+                self.save_image(
+                    mosaic.image(),
+                    os.path.join(
+                        self.title_folder,
+                        sink.base_folder,
+                        "Norder" + str(order),
+                        "Allsky." + self.tile_extension,
+                    ),
+                )
+
+    def fill_allsky(self, mosaic, base_folder, extension=None):
+        """Fills an Allsky mosaic by reading every tile of its order from the tiling. Sparse
+            tilings skip the tiles they do not have.
+
+        Args:
+            mosaic (AllskyMosaic): The mosaic to fill.
+            base_folder (String): The base folder of the tiling.
+            extension (String, optional): The file extension of the tiles. Defaults to None,
+                which uses the extension of the tile format.
+        """
+        for i in range(12 * 4**mosaic.order):
+            encoded = self.read_tile(base_folder, mosaic.order, i, extension)
+            if encoded is None:
+                if self.sparse:
+                    continue
+                file = self.tile_file(base_folder, mosaic.order, i, extension)
+                raise RuntimeError("Tile not found: " + str(file))
+            mosaic.add(i, np.array(Image.open(io.BytesIO(encoded)).convert("RGB")))
+        mosaic.flush()
+
+    def create_allsky(self, edge_width=None, extension=None, base_folder="projection"):
+        """Creates the Allsky images of an existing tiling by reading all of its tiles. Builds
+            collect them while rendering, so this is only needed for tilings built without.
+
+        Args:
+            edge_width (int, optional): The edge length of a tile in the Allsky images.
+                Defaults to None, which uses allsky_edge_width.
+            extension (String, optional): The file extension of the tiles. Defaults to None,
+                which uses the extension of the tile format.
+            base_folder (String, optional): The base folder of the tiling.
+                Defaults to "projection".
+        """
+        print("Create allsky images ...")
+        for order in self.allsky_orders():
+            mosaic = self.allsky_mosaic(base_folder, order, edge_width)
+            mosaic.prepare(False, self.allsky_color())
+            self.fill_allsky(mosaic, base_folder, extension)
+            self.save_image(
+                mosaic.image(),
+                os.path.join(
+                    self.title_folder,
+                    base_folder,
+                    "Norder" + str(order),
+                    "Allsky." + self.tile_extension,
+                ),
+            )
+        print("Create allsky images ... done.")
+
+    def make_hips_hierarchy(
+        self, data_path, circle=True, workers=1, incremental=False, allsky=True
+    ):
+        if self.sparse:
+            raise ValueError("Hierarchies fill every tile and cannot be sparse.")
+        self.check_folders("projection", incremental)
+        self.create_folders("projection", packed=self.packed)
+        self.create_hips_properties("projection")
+        self.create_index_file("projection")
+        manifest = TileManifest(self.title_folder / Path("projection") / Path("manifest.jsonl"))
+
+        dataset = ImageStore.open_or_pack(self.image_store_folder, data_path)
+        dataset_length = len(dataset)
+        sink, refill = self.create_tile_sink(
+            "projection", manifest, allsky, incremental, dedup=self.dedup
+        )
+
+        print("Creating Healpix tiles...")
+        with TilePool(self, workers, dataset=dataset, sink=sink) as pool:
+            for order in range(self.max_order+1):
+                n_side = 2**(order)
+                n_pix = 12 * n_side**2
+                ds_idx = pyramid_offset(order) + np.arange(n_pix)
+                if circle:
+                    ds_idx = ds_idx % dataset_length
+                used = ds_idx < dataset_length
+                rows = np.minimum(ds_idx, dataset_length - 1)
+                tiles = self.plan_tiles(
+                    manifest,
+                    "projection",
+                    order,
+                    "hierarchy",
+                    np.where(used, dataset.ids[rows], -1).reshape(n_pix, 1),
+                    np.where(used, dataset.hashes[rows], 0).reshape(n_pix, 1),
+                    incremental,
+                )
+                self.metrics.count("tiles", len(tiles), order)
+                with self.metrics.stage("order", order):
+                    tiles, duplicates = self.deduplicate_tiles(sink, order, tiles)
+                    pool.run(
+                        hierarchy_tiles,
+                        [(order, chunk, circle) for chunk in pool.chunks(tiles)],
+                    )
+                    self.link_duplicates(sink, order, duplicates)
+        self.finish_tiling(sink, manifest, refill)
+        self.metrics.report(self.title)
+        print("...done.")
+
+
+def embed_tiles(state, order, tiles):
+    """Renders and saves the given dataset projection tiles of an order.
+
+    Args:
+        state (dict): The tile pool state holding the hipster, the catalog, the winners pyramid,
+            the dataset and the tile sink.
+        order (int): The HEALPix order of the tiles.
+        tiles (list): The (pixel, digest, ids) of the tiles to render.
+    """
+    hipster = state["hipster"]
+    group = max(1, hipster.render_batch_size // 4 ** hipster.hierarchy_levels())
+    for start in range(0, len(tiles), group):
+        batch = tiles[start : start + group]
+        pixels = [pixel for pixel, _, _ in batch]
+        with hipster.profile(order, pixels):
+            data = hipster.render_tiles(
+                state["dataset"], state["catalog"], order, pixels, state["winners"], recycle=True
+            )
+        for (pixel, digest, ids), tile in zip(batch, data):
+            state["sink"].write(order, pixel, tile, digest, ids)
+    state["sink"].flush()
+    return len(tiles)
+
+
+def bottom_up_tiles(state, order, pixels):
+    """Renders the subtrees below the given tiles of an order bottom-up.
+
+    Args:
+        state (dict): The tile pool state holding the hipster, the catalog, the winners pyramid,
+            the dataset, the digest and current pyramids and the tile sink.
+        order (int): The HEALPix order of the subtree roots.
+        pixels (range): The nested HEALPix pixels of the subtree roots.
+
+    Returns:
+        int: The number of subtree roots.
+    """
+    for pixel in pixels:
+        render_bottom_up(state, order, pixel)
+    state["sink"].flush()
+    return len(pixels)
+
+
+def render_bottom_up(state, order, pixel):
+    """Renders a tile and, depth-first, all of its descendants that are not current.
+
+    Args:
+        state (dict): The tile pool state, see bottom_up_tiles.
+        order (int): The HEALPix order of the tile.
+        pixel (int): The nested HEALPix pixel of the tile.
+    """
+    hipster = state["hipster"]
+    position = pyramid_offset(order) + pixel
+    if state["current"][position]:
+        return
+    if order == hipster.max_order:
+        with hipster.profile(order, [pixel]):
+            data = hipster.render_tiles(
+                state["dataset"], state["catalog"], order, [pixel], state["winners"]
+            )[0]
+        leaves = 4 ** hipster.hierarchy_levels()
+        start = pyramid_offset(order + hipster.hierarchy_levels()) + pixel * leaves
+        ids = [
+            int(state["catalog"].ids[row]) if row >= 0 else -1
+            for row in state["winners"][start : start + leaves]
+        ]
+    else:
+        for child in range(pixel * 4, pixel * 4 + 4):
+            render_bottom_up(state, order + 1, child)
+        data = hipster.compose_tile("projection", order, pixel)
+        ids = []
+    if order > 0:
+        hipster.keep_reduced("projection", order, pixel, data)
+    state["sink"].write(order, pixel, data, str(state["digests"][position]), ids)
+
+
+def hierarchy_tiles(state, order, tiles, circle):
+    """Renders and saves the given tiles of make_hips_hierarchy of an order.
+
+    Args:
+        state (dict): The tile pool state holding the hipster, the dataset and the tile sink.
+        order (int): The HEALPix order of the tiles.
+        tiles (list): The (pixel, digest, ids) of the tiles to render.
+        circle (bool): Whether to start over with the first image once all images are used.
+    """
+    hipster = state["hipster"]
+    if hipster.render_threads is not None:
+        torch.set_num_threads(hipster.render_threads)
+    dataset = state["dataset"].images
+    dataset_length = dataset.shape[0]
+    size = hipster.output_size
+    for start in range(0, len(tiles), hipster.render_batch_size):
+        batch = tiles[start : start + hipster.render_batch_size]
+        data = np.empty((len(batch), size, size, 3), dtype=np.uint8)
+        used = []
+        for i, (pix, _, _) in enumerate(batch):
+            ds_idx = pyramid_offset(order) + pix
+            if circle or ds_idx < dataset_length:
+                used.append((i, ds_idx % dataset_length))
+            else:
+                data[i] = EMPTY_COLOR
+        if len(used) > 0:
+            with hipster.metrics.stage("read", order):
+                images = torch.from_numpy(np.stack([dataset[row] for _, row in used]))
+            with hipster.profile(order, [pix for pix, _, _ in batch]):
+                with hipster.metrics.stage("project", order):
+                    images = functional.center_crop(
+                        images.permute(0, 3, 1, 2), [hipster.crop_size, hipster.crop_size]
+                    )
+                    images = functional.resize(
+                        images,
+                        [size, size],
+                        interpolation=functional.InterpolationMode.BICUBIC,
+                        antialias=True,
+                    )
+                    data[[i for i, _ in used]] = images.permute(0, 2, 3, 1).numpy()
+        for (pix, digest, ids), tile in zip(batch, data):
+            state["sink"].write(order, pix, tile, digest, ids)
+    state["sink"].flush()
+    return len(tiles)
+
+
+_tile_worker_state = {}
+
+
+def _init_tile_worker(hipster, shared):
+    torch.set_num_threads(hipster.render_threads or 1)
+    hipster.metrics = BuildMetrics()  # forked workers would inherit the records so far
+    _tile_worker_state["hipster"] = hipster
+    _tile_worker_state.update(TilePool.open_shared(shared))
+    if "sink" in _tile_worker_state:
+        _tile_worker_state["sink"].hipster = hipster  # record into the same metrics
+
+
+def _run_tile_task(task, args):
+    result = task(_tile_worker_state, *args)
+    return result, _tile_worker_state["hipster"].metrics.collect()
+
+
+class TilePool:
+    """Distributes the tiles of an order over a pool of worker processes.
+
+    The selected rows are written once to memory-mapped files in a temporary folder, and together
+    with the catalog and image stores every worker opens them memory-mapped, so they are neither
+    pickled per worker nor per task. Each tile only depends on its own cell, so the output
+    does not depend on the number of workers. With a single worker, the tiles are rendered in the
+    calling process.
+    """
+
+    def __init__(self, hipster, workers=1, **state):
+        """Initializes the pool
+
+        Args:
+            hipster (Hipster): The hipster rendering the tiles.
+            workers (int, optional): The number of worker processes. Defaults to 1.
+            **state: The data the tasks need, e.g. winners (numpy.ndarray or SparseWinners), index
+                (CatalogIndex), catalog (CatalogStore), dataset (ImageStore) or plain values such
+                as file names.
+        """
+        self.hipster = hipster
+        self.workers = workers
+        self.state = dict(state, hipster=hipster)
+        self.shared_folder = None
+        self.executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self.shared_folder = tempfile.TemporaryDirectory(
+                prefix=".shared", dir=self.hipster.title_folder
+            )
+            shared = {}
+            for name, value in self.state.items():
+                if name != "hipster" and value is not None:
+                    shared[name] = TilePool.share(Path(self.shared_folder.name) / name, value)
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                initializer=_init_tile_worker,
+                initargs=(self.hipster, shared),
+            )
+        return self
+
+    def __exit__(self, *exception):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.shared_folder is not None:
+            self.shared_folder.cleanup()
+
+    @staticmethod
+    def share(path, value):
+        """Writes a value to memory-mapped files and returns how to open it again.
+
+        Args:
+            path (Path): The path to write the value to, without extension.
+            value (numpy.ndarray, CatalogIndex, SparseWinners, CatalogStore or ImageStore): The
+                value to share.
+        """
+        if isinstance(value, CatalogIndex):
+            value.save(path)
+            return "index", str(path)
+        if isinstance(value, SparseWinners):
+            value.save(path)
+            return "sparse", str(path)
+        if isinstance(value, ImageStore):
+            return "images", str(value.folder)  # already memory-mapped
+        if isinstance(value, CatalogStore):
+            return "catalog", str(value.folder)
+        if not isinstance(value, np.ndarray):
+            return "value", value
+        if value.dtype == object:
+            value = value.astype(np.float64)
+        np.save(path.with_suffix(".npy"), value)
+        return "array", str(path.with_suffix(".npy"))
+
+    @staticmethod
+    def open_shared(shared):
+        """Opens the values shared by a pool.
+
+        Args:
+            shared (dict): The kind and path of each shared value by name.
+        """
+        state = {}
+        for name, (kind, path) in shared.items():  # path holds the value of plain values
+            if kind == "index":
+                state[name] = CatalogIndex.open(path)
+            elif kind == "sparse":
+                state[name] = SparseWinners.open(path)
+            elif kind == "images":
+                state[name] = ImageStore(path)
+            elif kind == "catalog":
+                state[name] = CatalogStore(path)
+            elif kind == "value":
+                state[name] = path
+            else:
+                state[name] = np.load(path, mmap_mode="r")
+        return state
+
+    def chunks(self, tiles):
+        """Splits the tiles of an order into chunks of consecutive tiles.
+
+        Args:
+            tiles (list): The tiles of the order.
+        """
+        size = max(1, math.ceil(len(tiles) / (self.workers * 4)))
+        return [tiles[start : start + size] for start in range(0, len(tiles), size)]
+
+    def run(self, task, arguments):
+        """Runs a tile task for every argument tuple and returns the results in order.
+
+        Args:
+            task (function): A module-level function taking the pool state and the arguments.
+            arguments (list): The argument tuples, one per chunk.
+        """
+        if self.executor is None:
+            return [task(self.state, *args) for args in arguments]
+        futures = [self.executor.submit(_run_tile_task, task, args) for args in arguments]
+        results = []
+        for future in futures:
+            result, records = future.result()
+            self.hipster.metrics.merge(records)
+            results.append(result)
+        return results
+
+
+class CatalogIndex:
+    """Spatial index of a catalog: its rows sorted by their nested HEALPix pixel at a fixed order.
+
+    As nested pixels of lower orders are prefixes of the pixels below them, the rows of any cell
+    (order, pixel) up to the index order form a contiguous slice of the sorted rows, found with a
+    bit shift and a binary search.
+    """
+
+    def __init__(self, rows, pixels, order):
+        """Initializes the index
+
+        Args:
+            rows (numpy.ndarray): The catalog rows, sorted by their pixel.
+            pixels (numpy.ndarray): The sorted pixels of the rows at the index order.
+            order (int): The HEALPix order of the pixels.
+        """
+        self.rows = rows
+        self.pixels = pixels
+        self.order = order
+
+    @staticmethod
+    def build(vectors, order):
+        """Indexes the given positions with a single vectorized vec2pix call and a stable sort.
+
+        Args:
+            vectors (numpy.ndarray): The (N, 3) positions of the catalog rows.
+            order (int): The HEALPix order to index at.
+        """
+        pixels = healpy.vec2pix(
+            2**order, vectors[:, 0], vectors[:, 1], vectors[:, 2], nest=True
+        ).astype(np.int64)
+        rows = np.argsort(pixels, kind="stable")
+        return CatalogIndex(rows, pixels[rows], order)
+
+    @staticmethod
+    def open(folder):
+        """Opens a saved index memory-mapped.
+
+        Args:
+            folder (String): The folder the index was saved to.
+        """
+        folder = Path(folder)
+        return CatalogIndex(
+            np.load(folder / "rows.npy", mmap_mode="r"),
+            np.load(folder / "pixels.npy", mmap_mode="r"),
+            int(np.load(folder / "order.npy")),
+        )
+
+    def save(self, folder):
+        """Saves the index.
+
+        Args:
+            folder (String): The folder to save the index to.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder / "rows.npy", self.rows)
+        np.save(folder / "pixels.npy", self.pixels)
+        np.save(folder / "order.npy", np.int64(self.order))
+
+    def offsets(self, order):
+        """Returns where the rows of every cell of an order start in the sorted rows.
+
+        Args:
+            order (int): The HEALPix order, at most the index order.
+
+        Returns:
+            numpy.ndarray: 12 * 4**order + 1 offsets, the rows of cell j are
+                rows[offsets[j]:offsets[j + 1]].
+        """
+        shift = 2 * (self.order - order)
+        return np.searchsorted(
+            self.pixels, np.arange(12 * 4**order + 1, dtype=np.int64) << shift
+        )
+
+    def cell(self, order, pixel):
+        """Returns the catalog rows within a cell.
+
+        Args:
+            order (int): The HEALPix order of the cell, at most the index order.
+            pixel (int): The nested HEALPix pixel of the cell.
+        """
+        shift = 2 * (self.order - order)
+        start, stop = np.searchsorted(self.pixels, [pixel << shift, (pixel + 1) << shift])
+        return self.rows[start:stop]
+
+
+class SimilarityIndex:
+    """k-nearest-neighbour index over the embedding of a catalog, for brushing and linking.
+
+    Every row is a point of its unit vector (x, y, z), optionally extended by further numeric
+    catalog columns, standardized and weighted, and indexed by a KD-tree; for unit vectors the
+    Euclidean distance grows with the angle. The points are saved with the lookup of rows by id
+    and a CatalogIndex at order 29, and the tree is built from the points again when the index is
+    opened, so queries by ids or HEALPix region only touch the tree and the rows they ask for,
+    never the whole catalog.
+    """
+
+    def __init__(self, folder):
+        """Opens a saved index
+
+        Args:
+            folder (String): The folder of the index.
+        """
+        from scipy.spatial import cKDTree
+
+        self.folder = Path(folder)
+        with open(self.folder / "similarity.json", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.tree = cKDTree(
+            np.load(self.folder / "points.npy", mmap_mode="r"),
+            leafsize=32,
+            balanced_tree=False,
+            compact_nodes=False,
+        )
+        self.ids = np.load(self.folder / "ids.npy", mmap_mode="r")
+        self.sorted_ids = np.load(self.folder / "sorted_ids.npy", mmap_mode="r")
+        self.id_order = np.load(self.folder / "id_order.npy", mmap_mode="r")
+        self.cells = CatalogIndex.open(self.folder / "cells")
+
+    @staticmethod
+    def features(catalog, columns=(), weights=None, chunk_size=2**20):
+        """Returns the points of the catalog rows and how the columns were scaled.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            columns (list, optional): Further numeric columns to compare rows by.
+                Defaults to ().
+            weights (list, optional): The weight of every column. Defaults to None, which
+                weighs them like one coordinate of the unit vectors.
+            chunk_size (int, optional): The number of rows to scale at once. Defaults to 2**20.
+
+        Returns:
+            tuple: The (N, 3 + len(columns)) float64 points, and the mean and scale of every
+                column.
+        """
+        weights = [1.0] * len(columns) if weights is None else [float(w) for w in weights]
+        if len(weights) != len(columns):
+            raise ValueError("Expected one weight per column, got " + str(len(weights)))
+        points = np.empty((len(catalog), 3 + len(columns)), dtype=np.float64)
+        points[:, :3] = catalog.positions()
+        means, scales = [], []
+        for i, (name, weight) in enumerate(zip(columns, weights)):
+            values = catalog.columns[name]
+            if values.dtype.kind not in "iufb":
+                raise ValueError("Column " + name + " is not numeric.")
+            mean = float(np.mean(values, dtype=np.float64))
+            deviation = float(np.std(values, dtype=np.float64))
+            scale = weight / deviation if deviation > 0 else 0.0
+            for start in range(0, len(catalog), chunk_size):
+                chunk = values[start : start + chunk_size].astype(np.float64)
+                points[start : start + chunk_size, 3 + i] = (chunk - mean) * scale
+            means.append(mean)
+            scales.append(scale)
+        return points, means, scales
+
+    @staticmethod
+    def build(folder, catalog, columns=(), weights=None):
+        """Builds the index of a catalog and saves it to a folder.
+
+        Args:
+            folder (String): The folder to save the index to.
+            catalog (CatalogStore): The catalog.
+            columns (list, optional): Further numeric columns to compare rows by, see features.
+                Defaults to ().
+            weights (list, optional): The weight of every column, see features.
+                Defaults to None.
+        """
+        folder = Path(folder)
+        rmtree(folder, ignore_errors=True)
+        folder.mkdir(parents=True)
+        points, means, scales = SimilarityIndex.features(catalog, columns, weights)
+        np.save(folder / "points.npy", points)
+        ids = np.asarray(catalog.ids)
+        id_order = np.argsort(ids, kind="stable")
+        np.save(folder / "ids.npy", ids)
+        np.save(folder / "sorted_ids.npy", ids[id_order])
+        np.save(folder / "id_order.npy", id_order)
+        CatalogIndex.build(points[:, :3], 29).save(folder / "cells")
+        meta = {
+            "path": catalog.meta["path"],
+            "source": catalog.meta["source"],
+            "rows": len(catalog),
+            "columns": list(columns),
+            "weights": None if weights is None else [float(w) for w in weights],
+            "means": means,
+            "scales": scales,
+        }
+        with open(folder / "similarity.json", "w", encoding="utf-8") as file:
+            json.dump(meta, file)  # written last, so the index is complete once it exists
+        return SimilarityIndex(folder)
+
+    @staticmethod
+    def open_or_build(folder, catalog, columns=(), weights=None):
+        """Opens the index in a folder, building it first if it is missing or was built from
+            another catalog or with other columns.
+
+        Args:
+            folder (String): The folder of the index.
+            catalog (CatalogStore): The catalog.
+            columns (list, optional): Further numeric columns to compare rows by, see features.
+                Defaults to ().
+            weights (list, optional): The weight of every column, see features.
+                Defaults to None.
+        """
+        if (Path(folder) / "similarity.json").exists() and (Path(folder) / "points.npy").exists():
+            index = SimilarityIndex(folder)
+            meta = index.meta
+            if (
+                meta["path"] == catalog.meta["path"]
+                and meta["source"] == catalog.meta["source"]
+                and meta["columns"] == list(columns)
+                and meta["weights"] == (None if weights is None else [float(w) for w in weights])
+            ):
+                return index
+        return SimilarityIndex.build(folder, catalog, columns, weights)
+
+    def rows(self, ids):
+        """Returns the rows of the given ids, -1 for ids that are not in the catalog.
+
+        Args:
+            ids (numpy.ndarray): The ids to look up.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_ids, ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == ids, self.id_order[positions], -1)
+
+    def query(self, points, k, exclude=None):
+        """Finds the k rows closest to each of a batch of points.
+
+        Args:
+            points (numpy.ndarray): The (N, dimensions) points.
+            k (int): The number of rows to return per point.
+            exclude (numpy.ndarray, optional): The rows never to return. Defaults to None.
+
+        Returns:
+            tuple: The (N, k) ids and distances of the closest rows, -1 and inf where the
+                catalog has fewer rows.
+        """
+        exclude = np.empty(0, dtype=np.int64) if exclude is None else np.unique(exclude)
+        count = min(k + len(exclude), self.tree.n)
+        distances, rows = self.tree.query(points, k=max(count, 1))
+        distances = np.asarray(distances).reshape(len(points), -1)
+        rows = np.asarray(rows).reshape(len(points), -1)
+        missing = rows >= self.tree.n
+        excluded = np.isin(rows, exclude) | missing
+        # stable argsort moves the kept rows to the front in distance order
+        keep = np.argsort(excluded, axis=1, kind="stable")[:, :k]
+        rows = np.take_along_axis(rows, keep, axis=1)
+        distances = np.take_along_axis(distances, keep, axis=1)
+        dropped = np.take_along_axis(excluded, keep, axis=1)
+        ids = np.asarray(self.ids)[np.where(dropped, 0, rows)]
+        result = np.full((len(points), k), -1, dtype=np.int64)
+        result[:, : rows.shape[1]] = np.where(dropped, -1, ids)
+        padded = np.full((len(points), k), np.inf)
+        padded[:, : distances.shape[1]] = np.where(dropped, np.inf, distances)
+        return result, padded
+
+    def similar(self, ids, k=10):
+        """Returns the k objects most similar to each of the given objects, without themselves.
+
+        Args:
+            ids (numpy.ndarray): The ids of the objects.
+            k (int, optional): The number of similar objects per object. Defaults to 10.
+
+        Returns:
+            tuple: The (len(ids), k) ids and distances of the similar objects, closest first.
+        """
+        rows = self.rows(ids)
+        if np.any(rows < 0):
+            raise KeyError("Unknown ids: " + str(np.asarray(ids)[rows < 0][:10].tolist()))
+        result = np.full((len(rows), k), -1, dtype=np.int64)
+        distances = np.full((len(rows), k), np.inf)
+        if len(rows) == 0:
+            return result, distances
+        # every object is its own closest point, so one more neighbour is asked for
+        found, found_distances = self.query(self.tree.data[rows], k + 1)
+        own = found == np.asarray(ids, dtype=np.int64)[:, None]
+        own[~own.any(axis=1), -1] = True  # e.g. duplicate points, drop the farthest
+        own &= np.cumsum(own, axis=1) == 1
+        result[:] = found[~own].reshape(len(rows), k)
+        distances[:] = found_distances[~own].reshape(len(rows), k)
+        return result, distances
+
+    def region(self, order, pixels):
+        """Returns the rows within HEALPix cells.
+
+        Args:
+            order (int): The HEALPix order of the cells, at most 29.
+            pixels (list): The nested HEALPix pixels of the cells.
+        """
+        rows = [self.cells.cell(order, int(pixel)) for pixel in pixels]
+        return np.unique(np.concatenate(rows)) if len(rows) > 0 else np.empty(0, np.int64)
+
+    def similar_to_region(self, order, pixels, k=10):
+        """Returns the k objects outside a HEALPix region most similar to the objects inside it,
+            i.e. closest to the mean of their points.
+
+        Args:
+            order (int): The HEALPix order of the cells of the region, at most 29.
+            pixels (list): The nested HEALPix pixels of the cells of the region.
+            k (int, optional): The number of similar objects. Defaults to 10.
+
+        Returns:
+            tuple: The k ids and distances of the similar objects, closest first, and the ids of
+                the objects within the region.
+        """
+        members = self.region(order, pixels)
+        if len(members) == 0:
+            return np.full(k, -1, dtype=np.int64), np.full(k, np.inf), members
+        center = self.tree.data[members].mean(axis=0)
+        ids, distances = self.query(center[None, :], k, exclude=members)
+        return ids[0], distances[0], np.asarray(self.ids)[members]
+
+
+class StatisticsPyramid:
+    """Count, minimum, maximum, mean and histogram of catalog columns for every occupied
+    HEALPix cell of every order down to a leaf order.
+
+    The leaf cells are reduced in one pass over the rows of a CatalogIndex, whose rows are sorted
+    by pixel, so the rows of a cell are a contiguous segment. Every parent order is rolled up from
+    the order below, whose cells are sorted as well, as parents are pixel >> 2. Values that are
+    not finite are left out of the statistics of their column.
+    """
+
+    def __init__(self, columns, edges, levels):
+        """Initializes the pyramid
+
+        Args:
+            columns (list): The names of the columns.
+            edges (numpy.ndarray): The (columns, bins + 1) histogram bin edges of every column.
+            levels (list): The statistics of every order, see level.
+        """
+        self.columns = list(columns)
+        self.edges = edges
+        self.levels = levels
+
+    @staticmethod
+    def build(catalog, index, columns, bins=16):
+        """Computes the statistics of a catalog.
+
+        Args:
+            catalog (CatalogStore): The catalog.
+            index (CatalogIndex): The spatial index of the catalog, its order is the leaf order.
+            columns (list): The numeric columns to compute the statistics of.
+            bins (int, optional): The number of histogram bins per column, spanning the range
+                of the column. Defaults to 16.
+        """
+        rows = np.asarray(index.rows)
+        pixels = np.asarray(index.pixels)
+        if len(rows) == 0:
+            starts = np.empty(0, dtype=np.int64)
+        else:
+            starts = np.flatnonzero(np.concatenate([[True], pixels[1:] != pixels[:-1]]))
+        cells = pixels[starts]
+        segments = np.repeat(np.arange(len(cells)), np.diff(np.append(starts, len(rows))))
+        level = {
+            "cells": cells,
+            "count": np.diff(np.append(starts, len(rows))).astype(np.int64),
+            "valid": np.zeros((len(columns), len(cells)), dtype=np.int64),
+            "sum": np.zeros((len(columns), len(cells))),
+            "min": np.full((len(columns), len(cells)), np.inf),
+            "max": np.full((len(columns), len(cells)), -np.inf),
+            "histogram": np.zeros((len(columns), len(cells), bins), dtype=np.int64),
+        }
+        edges = np.zeros((len(columns), bins + 1))
+        for i, name in enumerate(columns):
+            column = catalog.columns[name]
+            if column.dtype.kind not in "iufb":
+                raise ValueError("Column " + name + " is not numeric.")
+            values = np.asarray(column[rows], dtype=np.float64)
+            valid = np.isfinite(values)
+            low = values[valid].min() if valid.any() else 0.0
+            high = values[valid].max() if valid.any() else 0.0
+            edges[i] = np.linspace(low, high, bins + 1)
+            if len(cells) == 0:
+                continue
+            level["valid"][i] = np.add.reduceat(valid, starts)
+            level["sum"][i] = np.add.reduceat(np.where(valid, values, 0.0), starts)
+            level["min"][i] = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+            level["max"][i] = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+            scale = bins / (high - low) if high > low else 0.0
+            positions = np.clip(((values[valid] - low) * scale).astype(np.int64), 0, bins - 1)
+            level["histogram"][i] = np.bincount(
+                segments[valid] * bins + positions, minlength=len(cells) * bins
+            ).reshape(len(cells), bins)
+        levels = [level]
+        for _ in range(index.order):
+            levels.insert(0, StatisticsPyramid.roll_up(levels[0]))
+        return StatisticsPyramid(columns, edges, levels)
+
+    @staticmethod
+    def roll_up(level):
+        """Returns the statistics of the parent cells of a level.
+
+        Args:
+            level (dict): The statistics of an order, see level.
+        """
+        parents = level["cells"] >> 2
+        if len(parents) == 0:
+            return dict(level)
+        starts = np.flatnonzero(np.concatenate([[True], parents[1:] != parents[:-1]]))
+        return {
+            "cells": parents[starts],
+            "count": np.add.reduceat(level["count"], starts),
+            "valid": np.add.reduceat(level["valid"], starts, axis=1),
+            "sum": np.add.reduceat(level["sum"], starts, axis=1),
+            "min": np.minimum.reduceat(level["min"], starts, axis=1),
+            "max": np.maximum.reduceat(level["max"], starts, axis=1),
+            "histogram": np.add.reduceat(level["histogram"], starts, axis=1),
+        }
+
+    def level(self, order):
+        """Returns the statistics of the occupied cells of an order: their sorted pixels
+            ("cells") and row counts, and per column the number of finite values ("valid"),
+            their sum, minimum, maximum and histogram.
+
+        Args:
+            order (int): The HEALPix order.
+        """
+        return self.levels[order]
+
+    def summary(self, order, pixels):
+        """Summarizes a region from the statistics of its cells, without touching any row.
+
+        Args:
+            order (int): The HEALPix order of the cells of the region.
+            pixels (list): The nested HEALPix pixels of the cells of the region.
+
+        Returns:
+            dict: The number of rows ("count") and the count, min, max, mean and histogram of
+                every column by name.
+        """
+        level = self.levels[order]
+        pixels = np.asarray(pixels, dtype=np.int64)
+        positions = np.empty(0, dtype=np.int64)
+        if len(level["cells"]) > 0:
+            positions = np.searchsorted(level["cells"], pixels)
+            positions = np.minimum(positions, len(level["cells"]) - 1)
+            positions = np.unique(positions[level["cells"][positions] == pixels])
+        summary = {"count": int(level["count"][positions].sum())}
+        for i, name in enumerate(self.columns):
+            valid = int(level["valid"][i, positions].sum())
+            summary[name] = {
+                "count": valid,
+                "min": float(level["min"][i, positions].min()) if valid > 0 else None,
+                "max": float(level["max"][i, positions].max()) if valid > 0 else None,
+                "mean": float(level["sum"][i, positions].sum() / valid) if valid > 0 else None,
+                "histogram": level["histogram"][i, positions].sum(axis=0).tolist(),
+            }
+        return summary
+
+    def tiles(self, order, levels):
+        """Packs the statistics of the leaves of every occupied tile of an order.
+
+        A tile holds the statistics of its 4**levels leaf cells in nested order, as consecutive
+        little-endian blocks: the row count of every cell (uint32), then per column the number
+        of finite values (uint32), minimum, maximum and mean (float32, NaN for cells without
+        values) and histogram (uint32, bins per cell).
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+            levels (int): The number of orders below the tiles their leaves are at.
+
+        Returns:
+            tuple: The sorted pixels of the tiles and the bytes of each tile.
+        """
+        level = self.levels[order + levels]
+        leaves = 4**levels
+        tiles, tile_index = np.unique(level["cells"] >> (2 * levels), return_inverse=True)
+        slot = level["cells"] & (leaves - 1)
+
+        def dense(values, fill, dtype):
+            result = np.full((len(tiles), leaves) + values.shape[1:], fill, dtype=dtype)
+            result[tile_index, slot] = values
+            return result
+
+        blocks = [dense(level["count"], 0, "<u4")]
+        for i in range(len(self.columns)):
+            valid = level["valid"][i]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.where(valid > 0, level["sum"][i] / valid, np.nan)
+            blocks.append(dense(valid, 0, "<u4"))
+            blocks.append(dense(np.where(valid > 0, level["min"][i], np.nan), np.nan, "<f4"))
+            blocks.append(dense(np.where(valid > 0, level["max"][i], np.nan), np.nan, "<f4"))
+            blocks.append(dense(mean, np.nan, "<f4"))
+            blocks.append(dense(level["histogram"][i], 0, "<u4").reshape(len(tiles), -1))
+        return tiles, [
+            b"".join(block[t].tobytes() for block in blocks) for t in range(len(tiles))
+        ]
+
+
+class SparseWinners:
+    """The selected catalog rows of the occupied cells of every order, for sparse tilings.
+
+    Deep orders have far more cells than any catalog has rows, so instead of a full pyramid only
+    the occupied cells are kept, sorted by pixel, and looked up with a binary search. The leaves
+    of tiles a sparse tiling does not render are dropped, see Hipster.sparse_subdivided.
+    """
+
+    def __init__(self, cells, rows):
+        """Initializes the winners
+
+        Args:
+            cells (list): The sorted occupied pixels of every order.
+            rows (list): The selected catalog row of every occupied pixel of every order.
+        """
+        self.cells = list(cells)
+        self.rows = list(rows)
+
+    @staticmethod
+    def open(folder):
+        """Opens saved winners memory-mapped.
+
+        Args:
+            folder (String): The folder the winners were saved to.
+        """
+        folder = Path(folder)
+        orders = int(np.load(folder / "orders.npy"))
+        return SparseWinners(
+            [np.load(folder / ("cells" + str(i) + ".npy"), mmap_mode="r") for i in range(orders)],
+            [np.load(folder / ("rows" + str(i) + ".npy"), mmap_mode="r") for i in range(orders)],
+        )
+
+    def save(self, folder):
+        """Saves the winners.
+
+        Args:
+            folder (String): The folder to save the winners to.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        np.save(folder / "orders.npy", np.int64(len(self.cells)))
+        for i, (cells, rows) in enumerate(zip(self.cells, self.rows)):
+            np.save(folder / ("cells" + str(i) + ".npy"), cells)
+            np.save(folder / ("rows" + str(i) + ".npy"), rows)
+
+    def lookup(self, order, pixels):
+        """Returns the selected catalog rows of cells, -1 for empty cells.
+
+        Args:
+            order (int): The HEALPix order of the cells.
+            pixels (numpy.ndarray): The nested HEALPix pixels of the cells.
+        """
+        cells = self.cells[order]
+        pixels = np.asarray(pixels, dtype=np.int64)
+        if len(cells) == 0:
+            return np.full(pixels.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(cells, pixels), len(cells) - 1)
+        return np.where(cells[positions] == pixels, self.rows[order][positions], -1)
+
+    def tiles(self, order, levels):
+        """Returns the sorted pixels of the tiles of an order with any occupied leaf.
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+            levels (int): The number of orders below the tiles their leaves are at.
+        """
+        return np.unique(np.asarray(self.cells[order + levels]) >> (2 * levels))
+
+
+class TileManifest:
+    """Append-only log of the inputs every written tile was rendered from.
+
+    A line with the tile digest and the ids of its source images is appended right after a tile
+    is saved, so an interrupted build leaves a record of all completed tiles to resume from. Later
+    lines of a tile supersede earlier ones.
+    """
+
+    def __init__(self, file):
+        """Opens a manifest, dropping lines that an interrupted build left incomplete
+
+        Args:
+            file (String): The manifest file, which does not have to exist yet.
+        """
+        self.file = Path(file)
+        self.entries = {}
+        self.compact()
+
+    def reload(self):
+        """Reads the latest entry of every tile."""
+        self.entries = {}
+        if not self.file.exists():
+            return
+        with open(self.file, encoding="utf-8") as lines:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[(entry["order"], entry["pixel"])] = (entry["digest"], line)
+
+    def compact(self):
+        """Rewrites the manifest with only the latest, complete entry of every tile."""
+        self.reload()
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.file.with_suffix(".tmp")
+        with open(temporary, "w", encoding="utf-8") as output:
+            for key in sorted(self.entries):
+                output.write(self.entries[key][1].rstrip("\n") + "\n")
+        os.replace(temporary, self.file)
+
+    def is_current(self, order, pixel, digest):
+        """Checks whether a tile was completed with the given digest.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            digest (String): The digest of the current inputs of the tile.
+        """
+        entry = self.entries.get((order, pixel))
+        return entry is not None and entry[0] == digest
+
+    @staticmethod
+    def append(file, order, pixel, digest, ids):
+        """Records a completed tile. Single line appends are safe from several processes.
+
+        Args:
+            file (String): The manifest file.
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            digest (String): The digest of the inputs of the tile.
+            ids (list): The ids of the source images of the tile.
+        """
+        line = json.dumps({"order": order, "pixel": pixel, "digest": digest, "ids": ids})
+        with open(file, "a", encoding="utf-8") as output:
+            output.write(line + "\n")
+
+
+class TileArchive:
+    """Packs the encoded tiles of a tiling into one append-only archive file per order.
+
+    Norder{order}/tiles.pack holds the encoded tiles back to back, and every tile appended to it
+    adds a (pixel, offset, length) record to Norder{order}/tiles.journal. Both files are only
+    written with O_APPEND, so several processes can add tiles at once, and later records of a
+    tile supersede earlier ones. Tiles with the same content may share their bytes. Once a build
+    is done, index writes the latest record of every tile sorted by pixel to
+    Norder{order}/tiles.idx, which readers binary-search, e.g. serve_hips_archive.py.
+
+    Superseded versions stay in the archive until compact rewrites it, which builds do once they
+    take more than half of it.
+    """
+
+    RECORD = np.dtype([("pixel", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+    def __init__(self, folder):
+        """Initializes the archive
+
+        Args:
+            folder (String): The base folder of the tiling.
+        """
+        self.folder = Path(folder)
+        self.records = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["records"] = {}  # reloaded from the journals
+        return state
+
+    def file(self, order, kind):
+        """Returns a file of the archive of an order.
+
+        Args:
+            order (int): The HEALPix order.
+            kind (String): The kind of file, "pack", "journal" or "idx".
+        """
+        return self.folder / Path("Norder" + str(order)) / Path("tiles." + kind)
+
+    @staticmethod
+    def write(file, data):
+        """Appends bytes to a file in a single write and returns where they start.
+
+        Args:
+            file (Path): The file to append to.
+            data (bytes): The bytes to append.
+        """
+        descriptor = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.write(descriptor, data) != len(data):
+                raise OSError("Incomplete write to " + str(file))
+            return os.lseek(descriptor, 0, os.SEEK_CUR) - len(data)
+        finally:
+            os.close(descriptor)
+
+    def append(self, order, pixel, data):
+        """Appends an encoded tile.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            data (bytes): The encoded tile.
+        """
+        offset = TileArchive.write(self.file(order, "pack"), data)
+        record = np.array([(pixel, offset, len(data))], dtype=TileArchive.RECORD)
+        TileArchive.write(self.file(order, "journal"), record.tobytes())
+
+    def share(self, order, tiles):
+        """Adds tiles with the same content as archived tiles, whose records point at the bytes
+            of those tiles. Tiles of other orders are copied into the archive of the order once.
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+            tiles (list): The (pixel, (order, pixel) of the archived tile) of the tiles.
+        """
+        records = np.zeros(len(tiles), dtype=TileArchive.RECORD)
+        copies = {}
+        for i, (pixel, source) in enumerate(tiles):
+            record = self.find(*source)
+            if source[0] == order:
+                records[i] = (pixel, record["offset"], record["length"])
+                continue
+            if source not in copies:
+                copies[source] = TileArchive.write(self.file(order, "pack"), self.read(*source))
+            records[i] = (pixel, copies[source], record["length"])
+        if len(records) > 0:  # the journal is only read once all records are written
+            TileArchive.write(self.file(order, "journal"), records.tobytes())
+
+    def latest(self, order):
+        """Returns the latest journal record of every tile of an order, sorted by pixel.
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+        """
+        file = self.file(order, "journal")
+        size = os.path.getsize(file) if file.exists() else 0
+        if order in self.records and self.records[order][0] == size:
+            return self.records[order][1]
+        data = np.fromfile(file, dtype=np.uint8) if size > 0 else np.empty(0, dtype=np.uint8)
+        count = len(data) // TileArchive.RECORD.itemsize  # drops an interrupted record
+        journal = data[: count * TileArchive.RECORD.itemsize].view(TileArchive.RECORD)[::-1]
+        _, latest = np.unique(journal["pixel"], return_index=True)
+        self.records[order] = (size, journal[latest])
+        return self.records[order][1]
+
+    def find(self, order, pixel):
+        """Returns the record of a tile, None if the archive does not have it.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+        """
+        records = self.latest(order)
+        position = np.searchsorted(records["pixel"], pixel)
+        if position < len(records) and records["pixel"][position] == pixel:
+            return records[position]
+        return None
+
+    def read(self, order, pixel):
+        """Returns an encoded tile, None if the archive does not have it.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+        """
+        record = self.find(order, pixel)
+        if record is None:
+            return None
+        with open(self.file(order, "pack"), "rb") as pack:
+            pack.seek(int(record["offset"]))
+            return pack.read(int(record["length"]))
+
+    def compact(self, order, threshold=0.0):
+        """Rewrites the archive of an order with only the latest version of every tile, if the
+            superseded versions take more than a share of it. Tiles sharing bytes keep sharing
+            them. No tiles may be added meanwhile.
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+            threshold (float, optional): The share of superseded bytes above which the archive
+                is rewritten. Defaults to 0.0, which rewrites any archive with superseded bytes.
+
+        Returns:
+            bool: Whether the archive was rewritten.
+        """
+        pack = self.file(order, "pack")
+        size = os.path.getsize(pack) if pack.exists() else 0
+        if size == 0:
+            return False
+        records = self.latest(order).copy()
+        spans, inverse = np.unique(
+            np.stack([records["offset"], records["length"].astype(np.uint64)], axis=1),
+            axis=0,
+            return_inverse=True,
+        )
+        if size - int(spans[:, 1].sum()) <= threshold * size:
+            return False
+        pack_part = Path(str(pack) + ".part")
+        with open(pack, "rb") as source, open(pack_part, "wb") as target:
+            for offset, length in spans.tolist():
+                source.seek(offset)
+                target.write(source.read(length))
+        offsets = np.concatenate([[0], np.cumsum(spans[:, 1])[:-1]]).astype(np.uint64)
+        records["offset"] = offsets[inverse.reshape(-1)]
+        journal = self.file(order, "journal")
+        journal_part = Path(str(journal) + ".part")
+        records.tofile(journal_part)
+        os.replace(pack_part, pack)
+        os.replace(journal_part, journal)
+        self.records.pop(order, None)
+        return True
+
+    def index(self, order):
+        """Writes the index of the latest version of every tile of an order.
+
+        Args:
+            order (int): The HEALPix order of the tiles.
+        """
+        file = self.file(order, "idx")
+        part = file.with_suffix(".part")
+        self.latest(order).tofile(part)
+        os.replace(part, file)
+
+
+class TileSink:
+    """Writes the rendered tiles of a build.
+
+    Tiles are handed to a pool of encoder threads through a bounded queue, so encoding and disk
+    I/O overlap with rendering the next tiles (PIL releases the GIL while encoding). The
+    thumbnail of every tile is streamed into the Allsky mosaic of its order, and a tile is only
+    recorded in the manifest once both the tile and its thumbnail are on disk, so a resumed build
+    never skips a tile that is missing.
+    """
+
+    def __init__(
+        self,
+        hipster,
+        base_folder,
+        manifest_file,
+        mosaics=None,
+        buffer_size=2**26,
+        queue_size=None,
+        dedup=False,
+        positional=False,
+    ):
+        """Initializes the sink
+
+        Args:
+            hipster (Hipster): The hipster the tiles belong to.
+            base_folder (String): The base folder of the tiling.
+            manifest_file (String): The manifest file to record the tiles in.
+            mosaics (dict, optional): The Allsky mosaics by order. Defaults to None.
+            buffer_size (int, optional): The number of bytes of tiles to buffer for the batched
+                thumbnail resize. Defaults to 64 MiB.
+            queue_size (int, optional): The number of tiles that may wait for an encoder.
+                Defaults to None, which allows two per encoder thread.
+            dedup (bool, optional): Whether tiles with the same digest share one blob.
+                Defaults to False.
+            positional (bool, optional): Whether the content of tiles with images depends on
+                their position and not only on their digest. Defaults to False.
+        """
+        self.hipster = hipster
+        self.base_folder = base_folder
+        self.manifest_file = manifest_file
+        self.mosaics = mosaics if mosaics is not None else {}
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size if queue_size is not None else 2 * hipster.encoder_threads
+        self.records = []
+        self.buffered = 0
+        self.encoders = None
+        self.slots = None
+        self.dedup = dedup
+        self.positional = positional
+        self.sources = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["encoders"] = None  # every process starts its own encoders
+        state["slots"] = None
+        state["records"] = []
+        state["sources"] = {}
+        return state
+
+    def content_key(self, digest, ids):
+        """Returns the key of the blob a tile shares with all tiles of the same content, None if
+            the tile is not deduplicated.
+
+        Args:
+            digest (String): The digest of the inputs of the tile.
+            ids (list): The ids of the source images of the tile.
+        """
+        if not self.dedup or digest == "":
+            return None
+        if self.positional and any(ident >= 0 for ident in ids):
+            return None  # e.g. distortion corrected tiles differ by their position
+        return digest
+
+    def write(self, order, pixel, data, digest, ids):
+        """Queues a tile for encoding. Blocks while the queue is full.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            data (numpy.ndarray): The (height, width, 3) uint8 tile, which must not be changed
+                afterwards. Buffers of the tile buffers of the hipster are returned to them once
+                the tile is encoded.
+            digest (String): The digest of the inputs of the tile.
+            ids (list): The ids of the source images of the tile.
+        """
+        key = self.content_key(digest, ids)
+        if self.hipster.encoder_threads > 0:
+            if self.encoders is None:
+                self.encoders = ThreadPoolExecutor(self.hipster.encoder_threads)
+                self.slots = threading.BoundedSemaphore(self.queue_size)
+            with self.hipster.metrics.stage("queue_wait", order):
+                self.slots.acquire()
+            encoded = self.encoders.submit(
+                self.hipster.save_tile, self.base_folder, order, pixel, data, key
+            )
+        else:
+            self.hipster.save_tile(self.base_folder, order, pixel, data, key)
+            encoded = None
+        self.records.append((encoded, (order, pixel, digest, ids)))
+        if order in self.mosaics:
+            self.mosaics[order].add(pixel, data)  # copies the tile
+            self.buffered += data.nbytes
+        if encoded is None:
+            self.hipster.tile_buffers.release(data)
+        else:
+            encoded.add_done_callback(lambda _: self.release(data))
+        if self.buffered >= self.buffer_size or (
+            len(self.mosaics) == 0 and len(self.records) >= self.queue_size
+        ):
+            self.flush()
+
+    def link(self, order, pixel, digest, ids, source=None):
+        """Writes a tile as a link to the blob of an already encoded tile with the same content.
+            The tiles of packed tilings are already shared in their archive, see link_duplicates.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            digest (String): The digest of the inputs of the tile.
+            ids (list): The ids of the source images of the tile.
+            source (tuple, optional): The (order, pixel) of a tile with the same content whose
+                thumbnail is copied. Defaults to None, which decodes the blob instead.
+        """
+        if not self.hipster.packed:
+            blob = self.hipster.blob_file(self.base_folder, self.content_key(digest, ids))
+            self.hipster.link_tile(self.base_folder, order, pixel, blob)
+        if order in self.mosaics:
+            if source is not None and source[0] in self.mosaics:
+                self.mosaics[order].copy(self.mosaics[source[0]], source[1], pixel)
+            else:
+                encoded = self.hipster.read_tile(self.base_folder, order, pixel)
+                data = np.array(Image.open(io.BytesIO(encoded)).convert("RGB"))
+                self.mosaics[order].add(pixel, data)
+                self.buffered += data.nbytes
+        self.records.append((None, (order, pixel, digest, ids)))
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def release(self, data):
+        """Frees the queue slot and the buffer of an encoded tile.
+
+        Args:
+            data (numpy.ndarray): The tile.
+        """
+        self.hipster.tile_buffers.release(data)
+        self.slots.release()
+
+    def flush(self):
+        """Waits for the queued tiles, writes the buffered thumbnails and records the tiles in
+        the manifest."""
+        with self.hipster.metrics.stage("thumbnails"):
+            for mosaic in self.mosaics.values():
+                mosaic.flush()
+        with self.hipster.metrics.stage("encode_wait"):
+            for encoded, _ in self.records:
+                if encoded is not None:
+                    encoded.result()
+        for _, record in self.records:
+            TileManifest.append(self.manifest_file, *record)
+        self.records = []
+        self.buffered = 0
+
+
+class AllskyMosaic:
+    """The Allsky image of an order, kept as a memory-mapped uint8 mosaic of tile thumbnails.
+
+    Tiles are buffered and resized to thumbnails in batches. Every tile has its own region of the
+    mosaic, so several processes can stream into the same file.
+    """
+
+    def __init__(self, file, order, edge_width):
+        """Initializes the mosaic
+
+        Args:
+            file (String): The .npy file holding the mosaic.
+            order (int): The HEALPix order of the tiles.
+            edge_width (int): The edge length of a thumbnail.
+        """
+        self.file = Path(file)
+        self.order = order
+        self.edge_width = edge_width
+        self.width = math.floor(math.sqrt(12 * 4**order))
+        self.height = math.ceil(12 * 4**order / self.width)
+        self.mosaic = None
+        self.pending = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["mosaic"] = None  # reopened by every process
+        state["pending"] = []
+        return state
+
+    def prepare(self, keep, color=None):
+        """Creates an empty mosaic file.
+
+        Args:
+            keep (bool): Whether to keep an existing mosaic file of the same shape instead.
+            color (list, optional): The color of tiles that are never added. Defaults to None,
+                which leaves them black.
+
+        Returns:
+            bool: Whether an existing mosaic was kept.
+        """
+        shape = (self.edge_width * self.height, self.edge_width * self.width, 3)
+        if keep and self.file.exists():
+            if np.load(self.file, mmap_mode="r").shape == shape:
+                return True
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        mosaic = np.lib.format.open_memmap(self.file, mode="w+", dtype=np.uint8, shape=shape)
+        if color is not None:
+            mosaic[:] = color
+        del mosaic
+        self.mosaic = None
+        return False
+
+    def add(self, pixel, data):
+        """Buffers a tile for its thumbnail.
+
+        Args:
+            pixel (int): The nested HEALPix pixel of the tile.
+            data (numpy.ndarray): The (height, width, 3) uint8 tile.
+        """
+        self.pending.append((pixel, np.array(data, dtype=np.uint8)))
+
+    def flush(self):
+        """Resizes the buffered tiles in one batch and writes their thumbnails to the mosaic."""
+        if len(self.pending) == 0:
+            return
+        if self.mosaic is None:
+            self.mosaic = np.load(self.file, mmap_mode="r+")
+        batch = torch.from_numpy(np.stack([data for _, data in self.pending]))
+        thumbnails = functional.resize(
+            batch.permute(0, 3, 1, 2), [self.edge_width, self.edge_width], antialias=True
+        ).permute(0, 2, 3, 1)
+        for (pixel, _), thumbnail in zip(self.pending, thumbnails.numpy()):
+            self.region(pixel)[:] = thumbnail
+        self.mosaic.flush()
+        self.pending = []
+
+    def copy(self, mosaic, source, pixel):
+        """Copies the thumbnail of a tile of the same or another mosaic to a tile. Thumbnails
+            only depend on the tile, so tiles with the same content share them across orders.
+
+        Args:
+            mosaic (AllskyMosaic): The mosaic holding the tile to copy.
+            source (int): The nested HEALPix pixel of the tile to copy.
+            pixel (int): The nested HEALPix pixel of the tile to copy to.
+        """
+        for opened in (mosaic, self):
+            opened.flush()
+            if opened.mosaic is None:
+                opened.mosaic = np.load(opened.file, mmap_mode="r+")
+        self.region(pixel)[:] = mosaic.region(source)
+
+    def region(self, pixel):
+        """Returns the view of the mosaic holding the thumbnail of a tile.
+
+        Args:
+            pixel (int): The nested HEALPix pixel of the tile.
+        """
+        x = pixel % self.width
+        y = pixel // self.width
+        return self.mosaic[
+            y * self.edge_width : (y + 1) * self.edge_width,
+            x * self.edge_width : (x + 1) * self.edge_width,
+        ]
+
+    def image(self):
+        """Returns the mosaic as an image."""
+        return Image.fromarray(np.asarray(np.load(self.file, mmap_mode="r")), mode="RGB")
+
+
+class ImageStore:
+    """The PNG images of a data set, packed into a single memory-mapped uint8 array.
+
+    Images are stored in file name order, together with the integer ids parsed from their file
+    names, the size and modification time of their files and a hash of their pixels. Reads map the
+    packed file copy-on-write, so they are lazy and zero-copy, and all worker processes share the
+    same pages of the page cache.
+    """
+
+    def __init__(self, folder):
+        """Opens a packed image store
+
+        Args:
+            folder (String): The folder of the store.
+        """
+        self.folder = Path(folder)
+        self.ids = np.load(self.folder / "ids.npy")
+        self.names = np.load(self.folder / "names.npy")
+        self.stats = np.load(self.folder / "stats.npy")
+        self.hashes = np.load(self.folder / "hashes.npy")
+        self.images = np.load(self.folder / "images.npy", mmap_mode="c")
+        self.id_order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.id_order]
+
+    @staticmethod
+    def scan(path):
+        """Lists the PNG images of a folder with the size and modification time of each file.
+
+        Args:
+            path (String): The folder containing the PNG images.
+        """
+        file_names = sorted(glob.glob("{0}/*.png".format(path)))
+        stats = np.array(
+            [(stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, file_names)],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        return file_names, stats
+
+    @staticmethod
+    def pack(folder, path, previous=None):
+        """Packs all PNG images of a folder into a new store, decoding them one by one.
+
+        Args:
+            folder (String): The folder to create the store in.
+            path (String): The folder containing the PNG images, which must all have the same
+                shape.
+            previous (ImageStore, optional): An outdated store of the same folder, whose images
+                are copied instead of decoded again if their files did not change.
+                Defaults to None.
+        """
+        print("Packing images of " + str(path) + " ...")
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        file_names, stats = ImageStore.scan(path)
+        if len(file_names) == 0:
+            raise FileNotFoundError("No PNG images found in " + str(path))
+        names = np.array([Path(file_name).name for file_name in file_names])
+        unchanged = {}
+        if previous is not None:
+            for row, (name, stat) in enumerate(zip(previous.names.tolist(), previous.stats)):
+                unchanged[(name, int(stat[0]), int(stat[1]))] = row
+        shape = np.array(Image.open(file_names[0]))[:, :, :3].shape
+        images = np.lib.format.open_memmap(
+            folder / "images.tmp.npy", mode="w+", dtype=np.uint8, shape=(len(file_names),) + shape
+        )
+        ids = np.full(len(file_names), -1, dtype=np.int64)
+        hashes = np.zeros(len(file_names), dtype=np.uint64)
+        for row, file_name in enumerate(file_names):
+            key = (names[row], int(stats[row, 0]), int(stats[row, 1]))
+            if key in unchanged and previous.images.shape[1:] == shape:
+                images[row] = previous.images[unchanged[key]]
+                hashes[row] = previous.hashes[unchanged[key]]
+            else:
+                image = np.array(Image.open(file_name))[:, :, :3]
+                if image.shape != shape:
+                    raise ValueError(
+                        "All images must have the same shape, "
+                        + file_name
+                        + " has "
+                        + str(image.shape)
+                    )
+                images[row] = image
+                hashes[row] = int.from_bytes(
+                    hashlib.blake2b(image.tobytes(), digest_size=8).digest(), "little"
+                )
+            stem = Path(file_name).stem
+            if stem.isdigit():
+                ids[row] = int(stem)
+        images.flush()
+        del images
+        os.replace(folder / "images.tmp.npy", folder / "images.npy")
+        np.save(folder / "names.npy", names)
+        np.save(folder / "stats.npy", stats)
+        np.save(folder / "hashes.npy", hashes)
+        np.save(folder / "ids.npy", ids)  # written last, marks the store as complete
+        print("Packing images of " + str(path) + " ... done.")
+        return ImageStore(folder)
+
+    @staticmethod
+    def open_or_pack(folder, path, ids=None):
+        """Opens the store in a folder, packing it first if it is missing or any image file was
+            added, removed or modified since.
+
+        Args:
+            folder (String): The folder of the store.
+            path (String): The folder containing the PNG images.
+            ids (numpy.ndarray, optional): The ids that must be contained in the store.
+                Defaults to None.
+        """
+        store = None
+        if (Path(folder) / "ids.npy").exists() and (Path(folder) / "hashes.npy").exists():
+            store = ImageStore(folder)
+            file_names, stats = ImageStore.scan(path)
+            names = [Path(file_name).name for file_name in file_names]
+            if store.names.tolist() != names or not np.array_equal(store.stats, stats):
+                store = ImageStore.pack(folder, path, store)
+        else:
+            store = ImageStore.pack(folder, path)
+        if ids is not None and not np.all(np.isin(ids, store.ids)):
+            missing = ids[~np.isin(ids, store.ids)]
+            raise FileNotFoundError(
+                "No images found for the ids " + str(missing[:10].tolist()) + " in " + str(path)
+            )
+        return store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, ids):
+        """Returns the rows of the given ids, -1 for ids that are not in the store.
+
+        Args:
+            ids (numpy.ndarray): The ids to look up.
+        """
+        positions = np.searchsorted(self.sorted_ids, ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == ids, self.id_order[positions], -1)
+
+    def __getitem__(self, ident):
+        """Returns the image of an id as a (channel, width, height) tensor view."""
+        row = self.rows(ident)
+        if row < 0:
+            raise KeyError(ident)
+        image = torch.from_numpy(self.images[row])
+        return torch.swapaxes(image, 0, 2)
+
+
+class CatalogStore:
+    """The columns of a catalog, ingested once into typed, memory-mapped binary files.
+
+    Every column is stored in its own raw file: ids as int64, the positions x, y and z as float32
+    and all other columns with the type pandas infers for them, widened whenever a later chunk
+    needs a wider type, e.g. integers to float64 once values are missing. Missing strings are
+    stored empty. Catalogs are read chunk by chunk from CSV, Parquet or HDF5, so only one chunk is
+    ever held in memory, and later builds only map the files again unless the source file changed.
+    """
+
+    TYPES = {"id": np.int64, "x": np.float32, "y": np.float32, "z": np.float32}
+
+    VOTABLE_TYPES = {"i": "long", "u": "long", "f": "double", "b": "boolean", "U": "char"}
+
+    def __init__(self, folder):
+        """Opens an ingested catalog
+
+        Args:
+            folder (String): The folder of the store.
+        """
+        self.folder = Path(folder)
+        with open(self.folder / "catalog.json", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.columns = OrderedDict()
+        for name, dtype in self.meta["columns"]:
+            self.columns[name] = np.memmap(
+                self.folder / (name + ".bin"), dtype=dtype, mode="r", shape=(self.meta["rows"],)
+            )
+        self.ids = self.columns["id"]
+
+    @staticmethod
+    def source(path):
+        """Returns the size and modification time of a catalog file."""
+        return [os.stat(path).st_size, os.stat(path).st_mtime_ns]
+
+    @staticmethod
+    def read(path, chunk_size):
+        """Reads a catalog file chunk by chunk.
+
+        Args:
+            path (String): The CSV, Parquet or HDF5 catalog file.
+            chunk_size (int): The number of rows per chunk.
+
+        Returns:
+            iterator: The chunks as pandas.DataFrame.
+        """
+        suffix = Path(path).suffix.lower()
+        if suffix in (".parquet", ".pq"):
+            import pyarrow.parquet
+
+            for batch in pyarrow.parquet.ParquetFile(path).iter_batches(chunk_size):
+                yield batch.to_pandas()
+        elif suffix in (".h5", ".hdf5", ".hdf"):
+            with pd.HDFStore(path, mode="r") as store:  # needs the table format
+                yield from store.select(store.keys()[0], chunksize=chunk_size)
+        else:
+            yield from pd.read_csv(path, chunksize=chunk_size, dtype=CatalogStore.TYPES)
+
+    @staticmethod
+    def ingest(folder, path, chunk_size=2**20):
+        """Ingests a catalog file into a new store.
+
+        Args:
+            folder (String): The folder to create the store in.
+            path (String): The CSV, Parquet or HDF5 catalog file, which must have the columns
+                id, x, y and z.
+            chunk_size (int, optional): The number of rows to read at once. Defaults to 2**20.
+        """
+        print("Ingesting catalog " + str(path) + " ...")
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / "catalog.json").unlink(missing_ok=True)
+        columns = None
+        files = {}
+        rows = 0
+        try:
+            for chunk in CatalogStore.read(path, chunk_size):
+                if columns is None:
+                    missing = [name for name in CatalogStore.TYPES if name not in chunk.columns]
+                    if missing:
+                        raise ValueError(
+                            "The catalog " + str(path) + " has no columns " + str(missing)
+                        )
+                    columns = []
+                    for name in chunk.columns:
+                        dtype = np.dtype(CatalogStore.TYPES.get(name, chunk[name].to_numpy().dtype))
+                        if dtype.kind not in "iufb":
+                            dtype = np.dtype("U")  # widened to the longest string below
+                        columns.append([str(name), dtype])
+                        files[name] = open(folder / (str(name) + ".tmp.bin"), "wb")
+                for column in columns:
+                    name, dtype = column
+                    if dtype.kind == "U":
+                        values = chunk[name].fillna("").to_numpy().astype(str)
+                        wider = values.dtype if values.dtype.itemsize > dtype.itemsize else dtype
+                    else:
+                        values = chunk[name].to_numpy()
+                        if values.dtype.kind not in "iufb":
+                            try:  # e.g. booleans with missing values
+                                values = values.astype(np.float64)
+                            except (TypeError, ValueError):
+                                raise ValueError(
+                                    "The column "
+                                    + name
+                                    + " of the catalog "
+                                    + str(path)
+                                    + " holds text after row "
+                                    + str(rows)
+                                )
+                        wider = dtype
+                        if name not in CatalogStore.TYPES:
+                            wider = np.result_type(dtype, values.dtype)
+                    if wider != dtype:
+                        files[name].close()
+                        column[1] = dtype = CatalogStore.widen(folder, name, dtype, wider)
+                        files[name] = open(folder / (name + ".tmp.bin"), "ab")
+                    files[name].write(values.astype(dtype).tobytes())
+                rows += len(chunk)
+                print(".", end="", flush=True)
+        finally:
+            for file in files.values():
+                file.close()
+        if columns is None:
+            raise ValueError("The catalog " + str(path) + " is empty")
+        for name, _ in columns:
+            os.replace(folder / (name + ".tmp.bin"), folder / (name + ".bin"))
+        with open(folder / "catalog.json", "w", encoding="utf-8") as file:
+            json.dump(  # written last, marks the store as complete
+                {
+                    "path": str(path),
+                    "source": CatalogStore.source(path),
+                    "rows": rows,
+                    "columns": [[name, dtype.str] for name, dtype in columns],
+                },
+                file,
+            )
+        print("\nIngesting catalog " + str(path) + " ... done.")
+        return CatalogStore(folder)
+
+    @staticmethod
+    def widen(folder, name, dtype, wider):
+        """Rewrites the values of a column ingested so far with a wider type, e.g. longer
+            strings or float64 for integers.
+
+        Args:
+            folder (Path): The folder of the store.
+            name (String): The name of the column.
+            dtype (numpy.dtype): The current type of the column.
+            wider (numpy.dtype): The wider type.
+
+        Returns:
+            numpy.dtype: The wider type.
+        """
+        file = folder / (name + ".tmp.bin")
+        file.with_suffix(".old").unlink(missing_ok=True)
+        os.replace(file, file.with_suffix(".old"))
+        with open(file.with_suffix(".old"), "rb") as source, open(file, "wb") as target:
+            while dtype.itemsize > 0:
+                block = source.read(dtype.itemsize * 2**16)
+                if not block:
+                    break
+                target.write(np.frombuffer(block, dtype=dtype).astype(wider).tobytes())
+        file.with_suffix(".old").unlink()
+        return wider
+
+    @staticmethod
+    def open_or_ingest(folder, path, chunk_size=2**20):
+        """Opens the store in a folder, ingesting the catalog first if the store is missing or
+            the catalog file changed since.
+
+        Args:
+            folder (String): The folder of the store.
+            path (String): The CSV, Parquet or HDF5 catalog file.
+            chunk_size (int, optional): The number of rows to read at once. Defaults to 2**20.
+        """
+        if (Path(folder) / "catalog.json").exists():
+            store = CatalogStore(folder)
+            if store.meta["path"] == str(path) and store.meta["source"] == CatalogStore.source(
+                path
+            ):
+                return store
+        return CatalogStore.ingest(folder, path, chunk_size)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def positions(self, rows=None):
+        """Returns the (N, 3) positions of the given rows, of all rows by default.
+
+        Args:
+            rows (numpy.ndarray, optional): The rows to return. Defaults to None.
+        """
+        if rows is None:
+            rows = slice(None)
+        return np.stack(
+            [np.asarray(self.columns[name][rows], dtype=np.float64) for name in ("x", "y", "z")],
+            axis=-1,
+        )
+
+    def write_votable(self, file, chunk_size=2**16):
+        """Writes the catalog as a VOTable, streaming its rows chunk by chunk.
+
+        Args:
+            file (String): The VOTable file.
+            chunk_size (int, optional): The number of rows to format at once.
+                Defaults to 2**16.
+        """
+        with open(file, "w", encoding="utf-8") as output:
+            output.write('<?xml version="1.0" encoding="utf-8"?>\n')
+            output.write(
+                '<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+            )
+            output.write(" <RESOURCE>\n  <TABLE>\n")
+            for name, column in self.columns.items():
+                datatype = CatalogStore.VOTABLE_TYPES[column.dtype.kind]
+                if column.dtype.kind == "f" and column.dtype.itemsize == 4:
+                    datatype = "float"
+                output.write(
+                    '   <FIELD name="'
+                    + escape(name, {'"': "&quot;"})
+                    + '" datatype="'
+                    + datatype
+                    + '"'
+                    + (' arraysize="*"' if datatype == "char" else "")
+                    + "/>\n"
+                )
+            output.write("   <DATA>\n    <TABLEDATA>\n")
+            for start in range(0, len(self), chunk_size):
+                values = [
+                    column[start : start + chunk_size].tolist()
+                    for column in self.columns.values()
+                ]
+                for row in zip(*values):
+                    output.write(
+                        "     <TR>"
+                        + "".join("<TD>" + escape(str(value)) + "</TD>" for value in row)
+                        + "</TR>\n"
+                    )
+            output.write("    </TABLEDATA>\n   </DATA>\n  </TABLE>\n </RESOURCE>\n</VOTABLE>\n")
+
+
+class TileGeometryCache:
+    """Keeps the distortion correction sampling maps of recently projected tiles.
+
+    The maps only depend on the tiling geometry, never on the image content, so they are kept in
+    an in-memory LRU and, if a cache folder is given, persisted as .npy files to be shared between
+    builds and surveys with the same tiling.
+    """
+
+    def __init__(self, cache_folder=None, max_entries=64):
+        """Initializes the cache
+
+        Args:
+            cache_folder (String, optional): The folder to persist the sampling maps in.
+                Defaults to None.
+            max_entries (int, optional): The number of sampling maps to keep in memory.
+                Defaults to 64.
+        """
+        self.cache_folder = Path(cache_folder) if cache_folder is not None else None
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_folder is not None:
+            self.cache_folder.mkdir(parents=True, exist_ok=True)
+
+    def get(self, order, pixel, output_size, crop_size):
+        """Returns the sampling map of a tile, computing it on a cache miss.
+
+        Args:
+            order (int): The HEALPix order of the tile.
+            pixel (int): The nested HEALPix pixel of the tile.
+            output_size (int): The edge length of the projected tile.
+            crop_size (int): The edge length of the (cropped) source image.
+
+        Returns:
+            numpy.ndarray: The int32 flat source pixel index for every tile pixel, -1 where the
+                tile pixel is not covered by the source image.
+        """
+        key = (order, pixel, output_size, crop_size)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        file = None
+        if self.cache_folder is not None:
+            file = self.cache_folder / Path(
+                "order{0}_pixel{1}_{2}_{3}.npy".format(*key)
+            )
+        if file is not None and file.exists():
+            sampling = np.load(file).astype(np.int32, copy=False)  # older caches hold int64
+            self.hits += 1
+        else:
+            sampling = distortion_sampling_map(*key)
+            self.misses += 1
+            if file is not None:
+                temporary = file.with_suffix(".tmp" + str(os.getpid()))
+                with open(temporary, "wb") as output:
+                    np.save(output, sampling)
+                os.replace(temporary, file)
+        self.entries[key] = sampling
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return sampling
+
+
+class TileBuffers:
+    """Recycles the uint8 buffers tiles are rendered into.
+
+    Large hierarchies render tiles of several thousand pixels per edge, so allocating a fresh
+    buffer for every tile costs page faults and drives up the peak memory. Buffers go back to the
+    pool once their tile is encoded and are handed out again for the next tiles. Tiles without
+    any image share a single read-only tile of the empty color instead of a buffer.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        """Initializes the pool
+
+        Args:
+            max_bytes (int, optional): The number of bytes of free buffers to keep.
+                Defaults to 256 MiB.
+        """
+        self.max_bytes = max_bytes
+        self.free = {}
+        self.free_bytes = 0
+        self.owned = set()
+        self.constants = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}  # every process keeps its own buffers
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def acquire(self, shape):
+        """Returns a buffer of the given shape, its content is undefined.
+
+        Args:
+            shape (tuple): The shape of the buffer.
+        """
+        with self.lock:
+            free = self.free.get(shape)
+            if free:
+                buffer = free.pop()
+                self.free_bytes -= buffer.nbytes
+                return buffer
+        buffer = np.empty(shape, dtype=np.uint8)
+        with self.lock:
+            self.owned.add(id(buffer))
+        return buffer
+
+    def release(self, buffer):
+        """Returns a buffer to the pool. Arrays that were not acquired from it are ignored.
+
+        Args:
+            buffer (numpy.ndarray): The buffer, which must not be used afterwards.
+        """
+        with self.lock:
+            if id(buffer) not in self.owned:
+                return
+            if self.free_bytes + buffer.nbytes > self.max_bytes:
+                self.owned.discard(id(buffer))
+                return
+            self.free.setdefault(buffer.shape, []).append(buffer)
+            self.free_bytes += buffer.nbytes
+
+    def constant(self, shape, color):
+        """Returns a shared read-only tile filled with a color.
+
+        Args:
+            shape (tuple): The (height, width, 3) shape of the tile.
+            color (numpy.ndarray): The uint8 color.
+        """
+        key = (shape, bytes(color))
+        with self.lock:
+            tile = self.constants.get(key)
+            if tile is None:
+                tile = np.empty(shape, dtype=np.uint8)
+                tile[:] = color
+                tile.flags.writeable = False
+                self.constants[key] = tile
+        return tile
+
+
+class BuildMetrics:
+    """Collects timers, counters and peak memory of the stages of a build, per HEALPix order.
+
+    Worker processes record into their own copy, which the tile pool merges back after every
+    task, so the figures cover the whole build. Seconds of stages running in several threads or
+    processes at once add up, like CPU time. Memory is measured per process running a stage: its
+    resident set size at the end of the stage ("rss_mb", the largest of all calls), how much it
+    grew during the stage ("rss_growth_mb", summed over all calls, including nested stages) and
+    the peak resident set size of the process so far ("peak_rss_mb", the largest of all
+    processes).
+    """
+
+    MAXIMA = ("rss_mb", "peak_rss_mb")  # merged by their maximum, all other values add up
+
+    def __init__(self, sinks=None):
+        """Initializes the metrics
+
+        Args:
+            sinks (list, optional): The sinks to report the metrics to, e.g. LogMetricsSink,
+                JsonMetricsSink or PrometheusMetricsSink. Defaults to None.
+        """
+        self.sinks = list(sinks) if sinks is not None else []
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"sinks": [], "records": OrderedDict()}  # copies start empty and report nothing
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, order=None):
+        """Times a stage and measures the growth of the resident set size during it.
+
+        Args:
+            name (String): The name of the stage.
+            order (int, optional): The HEALPix order the stage works on. Defaults to None.
+        """
+        start = time.perf_counter()
+        rss = current_rss_mb()
+        try:
+            yield
+        finally:
+            end_rss = current_rss_mb()
+            self.add(
+                name,
+                order,
+                seconds=time.perf_counter() - start,
+                calls=1,
+                rss_growth_mb=end_rss - rss,
+                rss_mb=end_rss,
+            )
+
+    def count(self, name, value=1, order=None):
+        """Adds to the counter of a stage.
+
+        Args:
+            name (String): The name of the stage.
+            value (int, optional): The value to add. Defaults to 1.
+            order (int, optional): The HEALPix order the stage works on. Defaults to None.
+        """
+        self.add(name, order, count=value)
+
+    def add(self, name, order, **values):
+        """Adds values to the record of a stage and updates its peak memory.
+
+        Args:
+            name (String): The name of the stage.
+            order (int): The HEALPix order the stage works on, None for the whole build.
+            **values: The seconds, calls, count and rss_growth_mb to add, and the rss_mb and
+                peak_rss_mb to take the maximum with. The peak defaults to the peak of this
+                process.
+        """
+        values.setdefault("peak_rss_mb", peak_rss_mb(children=False))
+        with self.lock:
+            record = self.records.get((name, order))
+            if record is None:
+                record = {
+                    "stage": name,
+                    "order": order,
+                    "seconds": 0.0,
+                    "calls": 0,
+                    "count": 0,
+                    "rss_growth_mb": 0.0,
+                    "rss_mb": 0.0,
+                    "peak_rss_mb": 0.0,
+                }
+                self.records[(name, order)] = record
+            for key, value in values.items():
+                if key in BuildMetrics.MAXIMA:
+                    record[key] = max(record[key], value)
+                else:
+                    record[key] += value
+
+    def collect(self):
+        """Returns the records collected so far and starts over."""
+        with self.lock:
+            records = list(self.records.values())
+            self.records = OrderedDict()
+        return records
+
+    def merge(self, records):
+        """Adds records collected by another process.
+
+        Args:
+            records (list): The records, see collect.
+        """
+        for record in records:
+            self.add(
+                record["stage"],
+                record["order"],
+                **{key: value for key, value in record.items() if key not in ("stage", "order")},
+            )
+
+    def summary(self, build):
+        """Returns all records of the build so far.
+
+        Args:
+            build (String): The name of the build.
+        """
+        with self.lock:
+            stages = [dict(record) for record in self.records.values()]
+        return {
+            "build": build,
+            "created": datetime.now().isoformat(),
+            "peak_rss_mb": max([peak_rss_mb()] + [stage["peak_rss_mb"] for stage in stages]),
+            "stages": stages,
+        }
+
+    def report(self, build):
+        """Writes the records of the build so far to every sink.
+
+        Args:
+            build (String): The name of the build.
+        """
+        summary = self.summary(build)
+        for sink in self.sinks:
+            sink.write(summary)
+
+
+class LogMetricsSink:
+    """Reports build metrics as one structured key=value log line per stage and order."""
+
+    def __init__(self, logger=None):
+        """Initializes the sink
+
+        Args:
+            logger (logging.Logger, optional): The logger to write to. Defaults to None, which
+                uses the logger "hipster".
+        """
+        self.logger = logger if logger is not None else logging.getLogger("hipster")
+
+    def write(self, summary):
+        for record in summary["stages"]:
+            self.logger.info(
+                "build=%s stage=%s order=%s seconds=%.3f calls=%d count=%d rss_mb=%.1f "
+                "rss_growth_mb=%.1f peak_rss_mb=%.1f",
+                summary["build"],
+                record["stage"],
+                "" if record["order"] is None else record["order"],
+                record["seconds"],
+                record["calls"],
+                record["count"],
+                record["rss_mb"],
+                record["rss_growth_mb"],
+                record["peak_rss_mb"],
+            )
+
+
+class JsonMetricsSink:
+    """Reports build metrics as a JSON file."""
+
+    def __init__(self, file):
+        """Initializes the sink
+
+        Args:
+            file (String): The JSON file, replaced on every report.
+        """
+        self.file = Path(file)
+
+    def write(self, summary):
+        temporary = self.file.with_name(self.file.name + ".tmp")
+        with open(temporary, "w", encoding="utf-8") as output:
+            json.dump(summary, output, indent=2)
+        os.replace(temporary, self.file)
+
+
+class PrometheusMetricsSink:
+    """Reports build metrics in the Prometheus text format, e.g. for the textfile collector of
+    the node exporter."""
+
+    def __init__(self, file, prefix="hipster"):
+        """Initializes the sink
+
+        Args:
+            file (String): The .prom file, replaced on every report.
+            prefix (String, optional): The prefix of the metric names. Defaults to "hipster".
+        """
+        self.file = Path(file)
+        self.prefix = prefix
+
+    def write(self, summary):
+        metrics = [
+            ("stage_seconds_total", "counter", "Seconds spent in a stage.", "seconds", 1),
+            ("stage_calls_total", "counter", "Number of times a stage ran.", "calls", 1),
+            ("stage_items_total", "counter", "Items counted by a stage.", "count", 1),
+            ("stage_rss_bytes", "gauge", "RSS at the end of a stage.", "rss_mb", 2**20),
+            ("stage_rss_growth_bytes", "gauge", "RSS growth in a stage.", "rss_growth_mb", 2**20),
+            ("stage_peak_rss_bytes", "gauge", "Peak RSS of a stage.", "peak_rss_mb", 2**20),
+        ]
+        lines = []
+        for name, kind, description, key, scale in metrics:
+            lines.append("# HELP " + self.prefix + "_" + name + " " + description)
+            lines.append("# TYPE " + self.prefix + "_" + name + " " + kind)
+            for record in summary["stages"]:
+                labels = 'build="{0}",stage="{1}",order="{2}"'.format(
+                    summary["build"],
+                    record["stage"],
+                    "" if record["order"] is None else record["order"],
+                )
+                lines.append(
+                    self.prefix
+                    + "_"
+                    + name
+                    + "{"
+                    + labels
+                    + "} "
+                    + repr(float(record[key] * scale))
+                )
+        lines.append("# TYPE " + self.prefix + "_peak_rss_bytes gauge")
+        lines.append(
+            self.prefix
+            + '_peak_rss_bytes{build="'
+            + summary["build"]
+            + '"} '
+            + repr(float(summary["peak_rss_mb"] * 2**20))
+        )
+        temporary = self.file.with_name(self.file.name + ".tmp")
+        with open(temporary, "w", encoding="utf-8") as output:
+            output.write("\n".join(lines) + "\n")
+        os.replace(temporary, self.file)
+
+
+def peak_rss_mb(children=True):
+    """Returns the peak resident set size of this process in MB, 0 where the resource module is
+    missing, e.g. on Windows.
+
+    Args:
+        children (bool, optional): Whether to include the children that finished and were
+            waited for. Defaults to True.
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB elsewhere
+    return peak * scale / 2**20
+
+
+def current_rss_mb():
+    """Returns the current resident set size of this process in MB, its peak where there is no
+    /proc file system."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mb(children=False)
+
+
+MAX_DENSE_ORDER = 9  # sparse tilings render every occupied tile up to this order
+EMPTY_COLOR = np.array([77, 0, 153], dtype=np.uint8)  # deep purple
+
+TILE_FORMATS = {
+    "jpeg": ("jpg", "JPEG"),
+    "png": ("png", "PNG"),
+    "webp": ("webp", "WEBP"),
+}  # format: (file extension, PIL format)
+
+
+def write_changed(file, data):
+    """Writes bytes to a file unless it already holds them, so unchanged files keep their
+    modification time.
+
+    Args:
+        file (String): The file.
+        data (bytes): The content.
+
+    Returns:
+        bool: Whether the file was written.
+    """
+    try:
+        if os.path.getsize(file) == len(data):
+            with open(file, "rb") as existing:
+                if existing.read() == data:
+                    return False
+    except OSError:
+        pass
+    with open(file, "wb") as output:
+        output.write(data)
+    return True
+
+
+def pyramid_offset(order):
+    """Returns the number of cells in all orders below the given one.
+
+    Per-cell values of all orders are stored in one flat "pyramid" array, in which the cell
+    (order, pixel) is found at pyramid_offset(order) + pixel.
+
+    Args:
+        order (int): The HEALPix order.
+    """
+    return 4 * (4**order - 1)
+
+
+def nested_subpixels(pixel, size):
+    """Computes the nested HEALPix indices of the size x size sub-pixels of a pixel.
+
+    Closed-form replacement of the recursive quadrant filling: the row bits of a sub-pixel make up
+    the even and the column bits the odd bits of its index below the parent pixel.
+
+    Args:
+        pixel (int): The nested HEALPix pixel to subdivide.
+        size (int): The number of sub-pixels per edge. Must be a power of 2.
+
+    Returns:
+        numpy.ndarray: The (size, size) matrix of nested sub-pixel indices.
+    """
+    levels = int(math.log2(size))
+    assert 2**levels == size
+    coordinates = np.arange(size, dtype=np.int64)
+    spread = np.zeros(size, dtype=np.int64)
+    for bit in range(levels):
+        spread |= ((coordinates >> bit) & 1) << (2 * bit)
+    return pixel * 4**levels + spread[:, None] + (spread[None, :] << 1)
+
+
+def distortion_sampling_map(order, pixel, output_size, size):
+    """Computes which source image pixel every pixel of a distortion corrected tile samples.
+
+    Args:
+        order (int): The HEALPix order of the tile.
+        pixel (int): The nested HEALPix pixel of the tile.
+        output_size (int): The edge length of the projected tile.
+        size (int): The edge length of the source image.
+
+    Returns:
+        numpy.ndarray: The (output_size, output_size) int32 flat source pixel indices, -1 where
+            the tile pixel is not covered by the source image.
+    """
+    healpix_pixel = nested_subpixels(pixel, output_size)
+    center_theta, center_phi = healpy.pix2ang(
+        2**order, pixel, nest=True
+    )  # theta 0...180 phi 0...360
+    max_theta = max_phi = 2 * math.pi / (4 * 2**order) / 2
+    target_theta, target_phi = healpy.pix2ang(
+        2**order * output_size, healpix_pixel, nest=True
+    )
+    delta_theta = target_theta - center_theta
+    delta_phi = target_phi - center_phi
+    if center_phi == 0:
+        delta_phi = np.where(target_phi > math.pi, delta_phi - 2 * math.pi, delta_phi)
+    # math.sin per distinct ring keeps the result bit-identical to the former scalar loop
+    rings, ring_index = np.unique(target_theta.ravel(), return_inverse=True)
+    ring_sin = np.array([math.sin(theta) for theta in rings])
+    delta_phi = delta_phi * ring_sin[ring_index].reshape(target_theta.shape)
+    target_x = np.trunc(size // 2 + delta_phi / max_phi * (size // 2 - 1)).astype(np.int64)
+    target_y = np.trunc(size // 2 + delta_theta / max_theta * (size // 2 - 1)).astype(np.int64)
+    valid = (target_x >= 0) & (target_y >= 0) & (target_x < size) & (target_y < size)
+    return np.where(valid, target_x * size + target_y, -1).astype(np.int32)  # below size**2
 
-    # Crop the center of the image
-    return img.crop((left, top, right, bottom))
 
 output_size=512,
 if __name__ == "__main__":
@@ -547,5 +4160,4 @@ if __name__ == "__main__":
     hipster = Hipster(output_folder=base_path, title=title, max_order=3, crop_size=350, catalog_file=catalog_path)
     hipster.make_hips_hierarchy(data_path)
     hipster.create_hips_properties('projection')
-    healpy.ang2pix(0, 90, 90)
-    hipster.create_allsky()
\ No newline at end of file
+    healpy.ang2pix(0, 90, 90)
\ No newline at end of file
@@ -0,0 +1,134 @@
+import argparse
+import mimetypes
+import mmap
+import os
+import re
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+
+# the index records written by TileArchive in create_hips_sphere.py
+RECORD = np.dtype([("pixel", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+TILE_URL = re.compile(r"^/(?:(.+)/)?Norder(\d+)/Dir\d+/Npix(\d+)\.\w+$")
+
+
+class PackedTiles:
+    """Reads tiles from the archives of packed HiPS tilings, memory-mapped.
+
+    The index and archive of an order are mapped on first use and mapped again once the index
+    changed, e.g. after an incremental build.
+    """
+
+    def __init__(self, root):
+        """Initializes the reader
+
+        Args:
+            root (Path): The folder the tilings are served from.
+        """
+        self.root = Path(root)
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def open(self, folder):
+        """Returns the index and archive of an order folder, None if it is not packed.
+
+        Args:
+            folder (Path): The Norder folder of a tiling.
+        """
+        index_file = folder / "tiles.idx"
+        try:
+            changed = index_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if folder not in self.orders or self.orders[folder][0] != changed:
+                index = np.fromfile(index_file, dtype=RECORD)
+                archive = b""
+                if len(index) > 0:
+                    with open(folder / "tiles.pack", "rb") as pack:
+                        archive = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+                self.orders[folder] = (changed, index, archive)
+            return self.orders[folder][1:]
+
+    def read(self, path):
+        """Returns the encoded tile at a standard HiPS tile path, None if it is not packed.
+
+        Args:
+            path (String): The URL path of the tile, e.g. /projection/Norder3/Dir0/Npix42.jpg.
+        """
+        match = TILE_URL.match(path)
+        if match is None:
+            return None
+        prefix, order, pixel = match.group(1) or "", int(match.group(2)), int(match.group(3))
+        folder = (self.root / prefix / ("Norder" + str(order))).resolve()
+        if self.root.resolve() not in folder.parents:
+            return None
+        opened = self.open(folder)
+        if opened is None:
+            return None
+        index, archive = opened
+        position = np.searchsorted(index["pixel"], pixel)
+        if position == len(index) or index["pixel"][position] != pixel:
+            return b""  # packed tilings have no file for missing tiles either
+        offset = int(index["offset"][position])
+        return archive[offset : offset + int(index["length"][position])]
+
+
+class ArchiveRequestHandler(SimpleHTTPRequestHandler):
+    """Serves tiles from the archives of packed tilings and every other file from disk."""
+
+    def __init__(self, *args, tiles=None, **kwargs):
+        self.tiles = tiles
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+        data = self.tiles.read(path)
+        if data is None:
+            return super().send_head()
+        if len(data) == 0:
+            self.send_error(404, "Tile not found")
+            return None
+        self.send_response(200)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.end_headers()
+        return BytesIO(data)
+
+    def end_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")  # the viewer runs on its own port
+        super().end_headers()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves HiPS tilings built with Hipster(packed=True) under the standard "
+        "Norder/Dir/Npix URLs."
+    )
+    parser.add_argument("folder", help="folder to serve, e.g. the title folder of a survey")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8083)
+    arguments = parser.parse_args()
+
+    root = Path(arguments.folder)
+    handler = partial(ArchiveRequestHandler, directory=str(root), tiles=PackedTiles(root))
+    server = ThreadingHTTPServer((arguments.host, arguments.port), handler)
+    print(
+        "Serving " + os.path.abspath(root) + " at http://" + arguments.host + ":" + str(arguments.port)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()